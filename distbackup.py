@@ -12,16 +12,47 @@ import stat
 import re
 import time
 import shutil
+import tempfile
 import subprocess
 import getopt
 import datetime
 import ConfigParser
+import json
+import sqlite3
 import gzip
+import zlib
+import zipfile
+import tarfile
+import StringIO
+import collections
+import pwd
+import grp
 import ftplib
-# import glob # Potential inclusion for cleanBackup
+import glob
+import distutils.spawn
+import hashlib
+import threading
+import Queue
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 ####################################################
 
+#
+#
+#
+class BackupError(Exception):
+    """Failure of a section (missing source, failed command...)
+
+    The section is recorded as failed in the journal and the run continues with the next sections.
+    """
+    pass
+
 #
 #
 #
@@ -45,23 +76,266 @@ class DatabaseBackup:
         output_filename = settings.get(section, 'output') + '.' + archive_format
         output_file = os.path.join(output_folder, output_filename)
 
+        # Dump of the changed tables only
+        if settings.has_option(section, 'per_table') and settings.get(section, 'per_table').lower().strip() == 'true':
+            if not handler in ['mysql','pgsql']:
+                return False
+            return DatabaseBackup.perTable(settings, section, handler, output_folder)
+
         # Call the right handler
         syncMethod = getattr(DatabaseBackup, handler)
         return syncMethod(settings, section, output_file)
 
+    @staticmethod
+    def perTable(settings, section, handler, output_folder):
+        """Per-table backup
+
+        Each table is dumped in its own file, only when its change signal (checksum, update time,
+        statistics counters) differs from the previous backup. The dumps of the unchanged tables are reused.
+        The signals are read again after the dumps, and the tables changed meanwhile are dumped again.
+        A manifest describes the backup (tables, signals, files and hashes).
+        """
+        name = settings.get(section, 'output')
+        tables_folder = os.path.join(output_folder, name + '.tables')
+        manifest_file = os.path.join(output_folder, name + '.manifest')
+
+        signalMethod = getattr(DatabaseBackup, handler + 'Signals')
+        tableMethod = getattr(DatabaseBackup, handler + 'Table')
+        schemaMethod = getattr(DatabaseBackup, handler + 'Schemas')
+
+        # Debug mode
+        if debug:
+            print DBG_MSG + "* " + handler + " per-table dump -> " + tables_folder + DBG_MSG_END
+            return {'file': manifest_file}
+
+        previous = {}
+        previous_schemas = {}
+        if os.path.isfile(manifest_file):
+            try:
+                f = open(manifest_file, 'r')
+                data = json.load(f)
+                f.close()
+                previous = data['tables']
+                previous_schemas = data['schemas']
+            except (OSError, IOError, ValueError, KeyError):
+                previous = {}
+
+        # Without the list of the tables, nothing is changed
+        try:
+            schema_dumps = schemaMethod(settings, section)
+            signals = signalMethod(settings, section)
+        except subprocess.CalledProcessError:
+            raise BackupError("Cannot read the tables of the database")
+        if not os.path.isdir(tables_folder):
+            os.makedirs(tables_folder)
+
+        def dump(params, filename):
+            """Dump into a temporary file, which replaces the previous dump only when the dump succeeds
+            """
+            process = subprocess.Popen(params, stdout=subprocess.PIPE)
+            writer = VolumeWriter(filename + '.tmp')
+            f = gzip.GzipFile(os.path.basename(filename), 'wb', fileobj=writer)
+            shutil.copyfileobj(process.stdout, f, 2**20)
+            f.close()
+            writer.close()
+            if process.wait() != 0:
+                os.remove(filename + '.tmp')
+                return None
+            os.rename(filename + '.tmp', filename)
+            return {'file': os.path.basename(filename), 'size': writer.size, 'md5': writer.md5(), 'date': time.time()}
+
+        def kept(entry):
+            return entry != None and os.path.isfile(os.path.join(tables_folder, entry['file']))
+
+        # The schemas (views, routines, roles...) are always dumped
+        # When a dump fails, the previous one is kept
+        failed = set()
+        schemas = {}
+        for key, params in schema_dumps:
+            entry = dump(params, os.path.join(tables_folder, DatabaseBackup.tableFile(key, 'schema')))
+            if entry == None:
+                failed.add(key)
+                entry = previous_schemas.get(key)
+            if kept(entry):
+                schemas[key] = entry
+
+        tables = {}
+        dumped = set()
+        consistent = False
+        checked = True
+        for attempt in range(3):
+            for key in sorted(signals):
+                entry = tables.get(key) or previous.get(key)
+                if entry != None and entry['signal'] == signals[key] and (entry['signal'] != None or key in dumped):
+                    filename = os.path.join(tables_folder, entry['file'])
+                    if os.path.isfile(filename) and os.path.getsize(filename) == entry['size']:
+                        tables[key] = entry
+                        continue
+                entry = dump(tableMethod(settings, section, key), os.path.join(tables_folder, DatabaseBackup.tableFile(key)))
+                if entry == None:
+                    # The previous dump keeps its own signal, so the table is dumped again by the next run
+                    failed.add(key)
+                    entry = tables.get(key) or previous.get(key)
+                    if kept(entry):
+                        tables[key] = entry
+                    continue
+                entry['signal'] = signals[key]
+                tables[key] = entry
+                dumped.add(key)
+                failed.discard(key)
+
+            # The tables changed during the dump are processed again
+            try:
+                after = signalMethod(settings, section)
+            except subprocess.CalledProcessError:
+                checked = False
+                break
+            if after == signals:
+                consistent = True
+                break
+            signals = after
+
+        # Remove the dumps of the dropped tables
+        used = [x['file'] for x in tables.values() + schemas.values()]
+        for f in os.listdir(tables_folder):
+            if not f in used:
+                os.remove(os.path.join(tables_folder, f))
+
+        manifest = {
+            'driver': handler,
+            'date': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'consistent': consistent and len(failed) == 0,
+            'schemas': schemas,
+            'tables': tables
+        }
+        f = open(manifest_file + '.tmp', 'w')
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.close()
+        os.rename(manifest_file + '.tmp', manifest_file)
+
+        if len(failed) > 0:
+            raise BackupError("Cannot dump " + ", ".join(sorted(failed)))
+        if not checked:
+            raise BackupError("Cannot read the tables of the database after the dump")
+
+        files = [os.path.join(tables_folder, x) for x in sorted(used)]
+        return {
+            'files': files + [manifest_file],
+            'tables': {'dumped': len(dumped), 'reused': len(tables) - len(dumped)}
+        }
+
+    @staticmethod
+    def tableFile(key, kind='sql'):
+        return key.replace('/', '_') + '.' + kind + '.gz'
+
+    @staticmethod
+    def query(params):
+        """Run a SQL client and return the rows (tab separated values)
+
+        A CalledProcessError is raised when the client fails (server down, access denied...)
+        """
+        process = subprocess.Popen(params, stdout=subprocess.PIPE)
+        output = process.communicate()[0]
+        if process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, params[0])
+        return [x.split('\t') for x in output.splitlines() if x != '']
+
+    @staticmethod
+    def mysqlDatabases(settings, section):
+        if settings.has_option(section, 'database') and settings.get(section, 'database') != 'all':
+            return settings.get(section, 'database').split(' ')
+        sql = "SELECT SCHEMA_NAME FROM information_schema.SCHEMATA WHERE SCHEMA_NAME NOT IN ('information_schema', 'performance_schema', 'sys')"
+        return [x[0] for x in DatabaseBackup.query(['mysql'] + DatabaseBackup.mysqlCredentials(settings, section) + ['-N', '-B', '-e', sql])]
+
+    @staticmethod
+    def mysqlSignals(settings, section):
+        """MySQL change signal of each table ('db.table'): UPDATE_TIME or CHECKSUM TABLE ('signal' setting)
+
+        Should not be called directly
+        """
+        client = ['mysql'] + DatabaseBackup.mysqlCredentials(settings, section) + ['-N', '-B', '-e']
+        databases = DatabaseBackup.mysqlDatabases(settings, section)
+        sql = "SELECT TABLE_SCHEMA, TABLE_NAME, UPDATE_TIME FROM information_schema.TABLES WHERE TABLE_TYPE = 'BASE TABLE' AND TABLE_SCHEMA IN (" + \
+            ", ".join(["'" + x.replace("'", "''") + "'" for x in databases]) + ")"
+
+        # MySQL 8 caches the UPDATE_TIME for 'information_schema_stats_expiry' seconds (a day by default)
+        if len(DatabaseBackup.query(client + ["SHOW VARIABLES LIKE 'information_schema_stats_expiry'"])) > 0:
+            sql = "SET SESSION information_schema_stats_expiry = 0; " + sql
+        rows = DatabaseBackup.query(client + [sql])
+        if settings.has_option(section, 'tables'):
+            tables = [x.strip(' ') for x in settings.get(section, 'tables').split(' ')]
+            rows = [x for x in rows if x[1] in tables]
+
+        signals = {}
+        for schema, table, update_time in rows:
+            signals[schema + '.' + table] = None if update_time == 'NULL' else update_time
+
+        if settings.has_option(section, 'signal') and settings.get(section, 'signal').strip() == 'checksum' and len(rows) > 0:
+            sql = "CHECKSUM TABLE " + ", ".join(["`" + x[0] + "`.`" + x[1] + "`" for x in rows])
+            for table, checksum in DatabaseBackup.query(client + [sql]):
+                signals[table] = None if checksum == 'NULL' else checksum
+        return signals
+
+    @staticmethod
+    def mysqlTable(settings, section, key):
+        (database, table) = key.split('.', 1)
+        return ['mysqldump'] + DatabaseBackup.mysqlCredentials(settings, section) + ['--single-transaction', database, table]
+
+    @staticmethod
+    def mysqlSchemas(settings, section):
+        """Definitions without data (views, routines, events) of each database
+        """
+        params = ['mysqldump'] + DatabaseBackup.mysqlCredentials(settings, section) + ['--no-data', '--routines', '--events']
+        return [(x, params + ['--databases', x]) for x in DatabaseBackup.mysqlDatabases(settings, section)]
+
+    @staticmethod
+    def pgsqlDatabases(settings, section):
+        if settings.has_option(section, 'database') and settings.get(section, 'database') != 'all':
+            return settings.get(section, 'database').split(' ')
+        sql = "SELECT datname FROM pg_database WHERE NOT datistemplate"
+        return [x[0] for x in DatabaseBackup.query(['psql', '-At', '-F', '\t', '-d', 'postgres', '-c', sql])]
+
+    @staticmethod
+    def pgsqlSignals(settings, section):
+        """PostgreSQL change signal of each table ('db.schema.table'): statistics counters and file node (changed by TRUNCATE)
+
+        Should not be called directly
+        """
+        signals = {}
+        sql = "SELECT t.schemaname, t.relname, t.n_tup_ins || ':' || t.n_tup_upd || ':' || t.n_tup_del || ':' || " + \
+            "pg_relation_filenode(t.relid) || ':' || COALESCE(d.stats_reset::text, '') " + \
+            "FROM pg_stat_user_tables t, pg_stat_database d WHERE d.datname = current_database()"
+        for database in DatabaseBackup.pgsqlDatabases(settings, section):
+            for schema, table, counters in DatabaseBackup.query(['psql', '-At', '-F', '\t', '-d', database, '-c', sql]):
+                signals[database + '.' + schema + '.' + table] = counters
+        return signals
+
+    @staticmethod
+    def pgsqlTable(settings, section, key):
+        (database, schema, table) = key.split('.', 2)
+        return ['pg_dump', '-t', '"' + schema.replace('"', '""') + '"."' + table.replace('"', '""') + '"', database]
+
+    @staticmethod
+    def pgsqlSchemas(settings, section):
+        """Definitions without data of each database, and the roles for a full backup
+        """
+        ret = [(x, ['pg_dump', '--schema-only', x]) for x in DatabaseBackup.pgsqlDatabases(settings, section)]
+        if not settings.has_option(section, 'database') or settings.get(section, 'database') == 'all':
+            ret.append(('globals', ['pg_dumpall', '--globals-only']))
+        return ret
+
     @staticmethod
     def mysql(settings, section, output_file):
         """Mysql backup handler
 
         Should not be called directly
         """
-        params = ['mysqldump']
-        if settings.has_option(section, 'credentials'):
-            params.append('--defaults-file=' + settings.get(section, 'credentials'))
-        if settings.has_option(section, 'user'):
-            params.append('--user=' + settings.get(section, 'user'))
-        if settings.has_option(section, 'password'):
-            params.append('--password=' + settings.get(section, 'password'))
+        params = ['mysqldump'] + DatabaseBackup.mysqlCredentials(settings, section)
+
+        # Base of the binlog archiving: consistent dump with its binlog coordinates
+        position = DatabaseBackup.logPosition(settings, section)
+        if position:
+            params = params + ['--single-transaction', DatabaseBackup.mysqlSourceData()]
 
         if settings.has_option(section, 'tables') and settings.has_option(section, 'database'):
             params.append(settings.get(section, 'database'))
@@ -79,15 +353,55 @@ class DatabaseBackup:
 
         # Processing the dump
         mysqldump = subprocess.Popen(params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        dump_output = mysqldump.communicate()[0]
+        source = ScanFile(mysqldump.stdout, MYSQL_POSITION_REG)
+        ret = writeOutput(settings, section, output_file, source)
+        checkExit('mysqldump', mysqldump.wait())
+
+        if position:
+            if source.match == None:
+                raise BackupError("Cannot read the binlog position of the dump")
+            return DatabaseBackup.savePosition(output_file, source.match.group(1) + ':' + source.match.group(2), ret)
+        return ret
+
+    @staticmethod
+    def mysqlSourceData():
+        """Option recording the binlog coordinates in the dump ('--source-data' replaces '--master-data' since MySQL 8.0.26)
+        """
+        try:
+            text = subprocess.Popen(['mysqldump', '--help'], stdout=subprocess.PIPE, stderr=subprocess.PIPE).communicate()[0]
+        except OSError:
+            text = ''
+        if '--source-data' in text:
+            return '--source-data=2'
+        return '--master-data=2'
 
-        f = gzip.open(output_file, 'wb')
-        f.write(dump_output)
+    @staticmethod
+    def logPosition(settings, section):
+        return settings.has_option(section, 'log_position') and settings.get(section, 'log_position').lower().strip() == 'true'
+
+    @staticmethod
+    def savePosition(output_file, position, ret):
+        """Write the log position of a dump next to it ('.position'), for the binlog action
+        """
+        position_file = splitext(output_file)[0] + '.position'
+        f = open(position_file, 'w')
+        f.write(position + '\n')
         f.close()
+        files = ret['files'] if ret.has_key('files') else [ret['file']]
+        return {'files': files + [position_file], 'md5': ret['md5']}
 
-        return {
-            'file': output_file
-        }
+    @staticmethod
+    def mysqlCredentials(settings, section):
+        """Connection parameters of the mysql commands
+        """
+        params = []
+        if settings.has_option(section, 'credentials'):
+            params.append('--defaults-file=' + settings.get(section, 'credentials'))
+        if settings.has_option(section, 'user'):
+            params.append('--user=' + settings.get(section, 'user'))
+        if settings.has_option(section, 'password'):
+            params.append('--password=' + settings.get(section, 'password'))
+        return params
 
     @staticmethod
     def pgsql(settings, section, output_file):
@@ -101,6 +415,10 @@ class DatabaseBackup:
         else:
             params = ['pg_dump', settings.get(section, 'database')]
 
+        # Base of the WAL archiving: physical backup (a logical dump cannot replay WAL)
+        if DatabaseBackup.logPosition(settings, section):
+            return DatabaseBackup.pgsqlBase(settings, section, output_file)
+
         # Debug mode
         if debug:
             print DBG_MSG + "* PostgreSQL dump -> " + output_file + DBG_MSG_END
@@ -108,18 +426,43 @@ class DatabaseBackup:
 
         # Processing the dump
         pgdump = subprocess.Popen(params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        dump_output = pgdump.communicate()[0]
+        ret = writeOutput(settings, section, output_file, pgdump.stdout)
+        checkExit(params[0], pgdump.wait())
 
-        f = gzip.open(output_file, 'wb')
-        f.write(dump_output)
-        f.close()
+        return ret
 
-        return {
-            'file': output_file
-        }
+    @staticmethod
+    def pgsqlBase(settings, section, output_file):
+        """PostgreSQL physical backup (pg_basebackup tar stream) and its WAL start point
+
+        Should not be called directly
+        """
+        output_file = splitext(output_file)[0] + '.tar.gz'
+        params = ['pg_basebackup', '-D', '-', '-F', 't', '-X', 'fetch', '-c', 'fast', '-v']
+
+        # Debug mode
+        if debug:
+            print DBG_MSG + "* PostgreSQL base backup -> " + output_file + DBG_MSG_END
+            return {'file': output_file}
+
+        # Processing the backup (the start point is given on the error output)
+        errors = tempfile.TemporaryFile()
+        basebackup = subprocess.Popen(params, stdout=subprocess.PIPE, stderr=errors)
+        ret = writeOutput(settings, section, output_file, basebackup.stdout)
+        code = basebackup.wait()
+        errors.seek(0)
+        text = errors.read()
+        errors.close()
+        sys.stderr.write(text)
+
+        checkExit('pg_basebackup', code)
+        match = re.search(r'log start point: (\S+) on timeline (\d+)', text)
+        if match == None:
+            raise BackupError("Cannot read the WAL start point of the base backup")
+        return DatabaseBackup.savePosition(output_file, match.group(1) + ' timeline ' + match.group(2), ret)
 
     @staticmethod
-    def mongodb(settings, section):
+    def mongodb(settings, section, output_file):
         """MongoDB backup handler
 
         Should not be called directly
@@ -136,16 +479,190 @@ class DatabaseBackup:
 
         # Processing the dump
         mongodump = subprocess.Popen(params, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-        dump_output = mongodump.communicate()[0]
+        ret = writeOutput(settings, section, output_file, mongodump.stdout)
+        checkExit('mongodump', mongodump.wait())
+
+        return ret
+
+#
+#
+#
+class LogBackup:
+    """Continuous archiving of the database logs (MySQL binlogs, PostgreSQL WAL segments)
+
+    The closed log files are compressed (in parallel) into a folder of the output folder
+    and copied into the archive folder. The last shipped file is recorded, so each run only ships the new ones.
+    Each archived log file is linked to the latest full dump of the 'base' section (segments.index),
+    with the log position of that dump, to allow a point-in-time recovery from it.
+    The base must record its position ('log_position'): binlog coordinates for MySQL, physical backup for PostgreSQL.
+    """
+
+    @staticmethod
+    def process(settings, section):
+        """Ship the new closed log files with the right database handler
+        """
+        if not settings.has_option(section, 'driver') or not settings.has_option(section, 'output'):
+            return False
+        handler = settings.get(section, 'driver')
+        if not handler in ['mysql','pgsql']:
+            return False
+
+        name = settings.get(section, 'output')
+        output_folder = os.path.join(settings.get('default', 'output'), name)
+        archive_folder = os.path.join(settings.get('default', 'archive'), name)
+        if settings.has_option(section, 'group'):
+            archive_folder = os.path.join(settings.get('default', 'archive'), settings.get(section, 'group'), name)
+        position_file = os.path.join(output_folder, 'position')
+
+        # Last shipped log file
+        position = ''
+        if os.path.isfile(position_file):
+            f = open(position_file, 'r')
+            position = f.read().strip()
+            f.close()
+
+        # Call the right handler to list the closed log files
+        logMethod = getattr(LogBackup, handler)
+        logs = [x for x in logMethod(settings, section) if os.path.basename(x) > position]
+        (base, base_position) = LogBackup.lastDump(settings, section)
+        if base != None and base_position == None:
+            print "The base dump " + base + " has no log position (log_position=true)"
 
-        f = gzip.open(output_file, 'wb')
-        f.write(dump_output)
+        # Debug mode
+        if debug:
+            print DBG_MSG + "* Ship " + handler + " logs -> " + output_folder + "\n  " + "\n  ".join(logs) + DBG_MSG_END
+            if base != None:
+                print DBG_MSG + "  (base: " + base + ", position: " + str(base_position) + ")" + DBG_MSG_END
+            return {'files': []}
+
+        for folder in [output_folder, archive_folder]:
+            if not os.path.isdir(folder):
+                os.makedirs(folder)
+
+        # The output folder only keeps the log files of the current run
+        for f in glob.glob(os.path.join(output_folder, '*.gz')):
+            os.remove(f)
+
+        def ship(log):
+            dest = os.path.join(output_folder, os.path.basename(log) + '.gz')
+            src = open(log, 'rb')
+            dst = gzip.open(dest + '.tmp', 'wb')
+            shutil.copyfileobj(src, dst, 2**20)
+            dst.close()
+            src.close()
+            os.rename(dest + '.tmp', dest)
+            shutil.copy2(dest, os.path.join(archive_folder, os.path.basename(dest)))
+            return dest
+
+        files = parallel_map(ship, logs, SyncBackup.parallel(settings, section))
+
+        # Link the log files to the full dump (and its log position), then save the position
+        f = open(os.path.join(archive_folder, 'segments.index'), 'a')
+        for log in logs:
+            f.write(os.path.basename(log) + '.gz\t' + (base or '-') + '\t' + datetime.datetime.now().strftime("%Y-%m-%d %H:%M") + '\t' + (base_position or '-') + '\n')
         f.close()
 
+        if len(logs) > 0:
+            f = open(position_file, 'w')
+            f.write(os.path.basename(logs[-1]))
+            f.close()
+
+        if settings.has_option(section, 'purge') and settings.get(section, 'purge').lower().strip() == 'true':
+            LogBackup.purge(settings, section, logs)
+
         return {
-            'file': output_file
+            'files': files
         }
 
+    @staticmethod
+    def mysql(settings, section):
+        """MySQL handler: closed binary logs
+
+        Should not be called directly
+        """
+        if not settings.has_option(section, 'binlog_index'):
+            return []
+        index_file = settings.get(section, 'binlog_index')
+
+        # Close the current binary log, so it can be shipped
+        if not debug and settings.has_option(section, 'flush') and settings.get(section, 'flush').lower().strip() == 'true':
+            subprocess.call(['mysql'] + DatabaseBackup.mysqlCredentials(settings, section) + ['-e', 'FLUSH BINARY LOGS'])
+
+        f = open(index_file, 'r')
+        logs = [x.strip() for x in f.readlines() if x.strip() != '']
+        f.close()
+        logs = [os.path.join(os.path.dirname(index_file), x) for x in logs]
+
+        # The last one is the active binary log
+        return sorted(logs[:-1], key=os.path.basename)
+
+    @staticmethod
+    def pgsql(settings, section):
+        """PostgreSQL handler: WAL segments copied by the archive_command
+
+        A segment smaller than 'wal_segment_size' is still being copied: it is not shipped, nor the next files,
+        so the position does not move past it.
+        Should not be called directly
+        """
+        if not settings.has_option(section, 'wal_dir'):
+            return []
+        wal_dir = settings.get(section, 'wal_dir')
+        segment_size = 16 * 2**20
+        if settings.has_option(section, 'wal_segment_size'):
+            segment_size = parse_size(settings.get(section, 'wal_segment_size'))
+        reg = re.compile(r'^[0-9A-F]{24}(\.partial|\.[0-9A-F]{8}\.backup)?$|^[0-9A-F]{8}\.history$')
+        segment_reg = re.compile(r'^[0-9A-F]{24}(\.partial)?$')
+
+        logs = []
+        for x in sorted(os.listdir(wal_dir)):
+            if not reg.match(x):
+                continue
+            if segment_reg.match(x) and os.path.getsize(os.path.join(wal_dir, x)) != segment_size:
+                print "Incomplete WAL segment " + x + ", shipped by the next run"
+                break
+            logs.append(os.path.join(wal_dir, x))
+        return logs
+
+    @staticmethod
+    def purge(settings, section, logs):
+        """Remove the shipped log files from their source
+        """
+        if settings.get(section, 'driver') == 'mysql':
+            if len(logs) > 0:
+                subprocess.call(['mysql'] + DatabaseBackup.mysqlCredentials(settings, section) + ['-e', "PURGE BINARY LOGS TO '" + os.path.basename(logs[-1]) + "'"])
+            return
+        for log in logs:
+            os.remove(log)
+
+    @staticmethod
+    def lastDump(settings, section):
+        """Latest archived full dump of the 'base' database section, and its log position
+        """
+        if not settings.has_option(section, 'base'):
+            return (None, None)
+        base = settings.get(section, 'base')
+        if not settings.has_section(base) or not settings.has_option(base, 'output'):
+            return (None, None)
+        folder = settings.get('default', 'archive')
+        if settings.has_option(base, 'group'):
+            folder = os.path.join(folder, settings.get(base, 'group'))
+        dumps = []
+        for f in glob.glob(os.path.join(folder, settings.get(base, 'output') + '_*')):
+            match = DATE_REG.search(os.path.basename(f))
+            if match != None and not f.endswith('.position'):
+                dumps.append(('-'.join(match.groups()), f))
+        if len(dumps) == 0:
+            return (None, None)
+        dump = max(dumps)[1]
+
+        position = None
+        position_file = splitext(dump)[0] + '.position'
+        if os.path.isfile(position_file):
+            f = open(position_file, 'r')
+            position = f.read().strip()
+            f.close()
+        return (dump, position)
+
 #
 #
 #
@@ -153,7 +670,7 @@ class SyncBackup:
     """Synchronization class
 
     Allow to synchronize a file or a folder wiht another host.
-    Can handle different protocols, like FTP, Rsync.
+    Can handle different protocols, like FTP, Rsync, S3.
     It should also allow to dynamically crypt the data when sending it to the other host.
     """
 
@@ -164,7 +681,7 @@ class SyncBackup:
         if not settings.has_option(section, 'protocol'):
             return False
         handler = settings.get(section, 'protocol')
-        if not handler in ['archive','copy','rsync','ftp']:
+        if not handler in ['archive','copy','rsync','ftp','s3']:
             return False
 
         # TODO : Manage group/file exclusion
@@ -201,6 +718,12 @@ class SyncBackup:
         # Get the "archive" folder (in 'default' section)
         archive_folder = settings.get('default', 'archive')
 
+        # Database dumps can be stored as binary deltas
+        delta = settings.has_option(section, 'delta') and settings.get(section, 'delta').lower().strip() == 'true'
+        delta_full_days = 7
+        if settings.has_option(section, 'delta_full_days'):
+            delta_full_days = int(settings.get(section, 'delta_full_days').strip())
+
         # Get files organized in groups
         groups = {
             '/': []
@@ -210,17 +733,37 @@ class SyncBackup:
             group = f[2]
             if not groups.has_key(group):
                 groups[group] = []
-            groups[group].append( filename )
+            groups[group].append( (filename, f[1]) )
+
+        # The archived files can be indexed in the catalog
+        catalog = settings.has_option(section, 'catalog') and settings.get(section, 'catalog').lower().strip() == 'true'
+        archived = []
 
         # Copy the files in the different groups
         date = datetime.datetime.now().strftime("%Y-%m-%d")
         for group in groups:
-            for f in groups[group]:
+            for f, file_section in groups[group]:
                 if not debug and (not os.path.exists(f) or not os.path.isfile(f)):
                     continue
+                # The database logs are already archived
+                if settings.get(file_section, 'type') == 'binlog':
+                    continue
                 (filename, ext) = splitext(os.path.basename(f))
+                if delta and ext == '.gz' and settings.get(file_section, 'type') in ['db', 'database']:
+                    DeltaArchive.archive(f, os.path.join(archive_folder, group), filename, date, delta_full_days)
+                    continue
                 dest = os.path.join(archive_folder, group, filename + '_' + date + ext)
                 SyncBackup.copy(f, dest)
+                archived.append((dest, group))
+
+        # Index the content of the archives (once per volume set)
+        if catalog and not debug:
+            db = Catalog(settings)
+            for dest, group in archived:
+                key = VOLUME_REG.sub('', dest)
+                if key == dest or dest.endswith('.001'):
+                    db.index(key, group, date)
+            db.close()
 
         # If we do not want to display it in the report
         return False
@@ -230,6 +773,7 @@ class SyncBackup:
         """Copy handler
 
         It is a basic handler which will just copy files
+        Files already copied (same size, not older) are skipped.
         """
         if not settings.has_option(section, 'dest'):
             return False
@@ -241,11 +785,20 @@ class SyncBackup:
             return True
 
         # Check
-        if not os.path.exists(dest) or not os.path.is_dir(dest):
-            return False
+        if not os.path.exists(dest) or not os.path.isdir(dest):
+            raise BackupError("Destination not found: " + dest)
+
+        def copyFile(f):
+            target = os.path.join(dest, os.path.basename(f))
+            if os.path.isfile(target) and os.path.getsize(target) == os.path.getsize(f) \
+                    and os.path.getmtime(target) >= os.path.getmtime(f):
+                return True
+            return subprocess.call(['cp', f, dest]) == 0
 
         # Performing the copy
-        ret = subprocess.call(['cp'] + [x[0] for x in seqfiles] + [dest])
+        results = parallel_map(copyFile, [x[0] for x in seqfiles], SyncBackup.parallel(settings, section))
+        if not all(results):
+            raise BackupError("Cannot copy " + str(results.count(False)) + " files to " + dest)
         return True
 
     @staticmethod
@@ -253,6 +806,7 @@ class SyncBackup:
         """Rsync handler
 
         An handler which can transfer through network using rsync
+        Files are sent by several rsync processes when 'parallel' is set.
         """
         if not settings.has_option(section, 'host'):
             return False
@@ -265,7 +819,15 @@ class SyncBackup:
             return True
 
         # Performing the copy
-        ret = subprocess.call(['rsync', '-qt', '--chmod=o-rwx'] + [x[0] for x in seqfiles] + [host])
+        # rsync already skips the files (volumes) which are up to date on the host
+        params = ['rsync', '-qt', '--partial', '--chmod=o-rwx']
+        workers = SyncBackup.parallel(settings, section)
+        if workers <= 1:
+            codes = [subprocess.call(params + [x[0] for x in seqfiles] + [host])]
+        else:
+            codes = parallel_map(lambda f: subprocess.call(params + [f, host]), [x[0] for x in seqfiles], workers)
+        if any(codes):
+            raise BackupError("rsync to " + host + " failed (exit code " + str(max(codes)) + ")")
         return True
 
     @staticmethod
@@ -273,6 +835,9 @@ class SyncBackup:
         """FTP handler
 
         When rsync is not available...
+        The files are uploaded with a '.part' name, renamed once complete.
+        The uploads are recorded in the output folder ('distbackup.ftp'): a file is skipped when the same local file
+        (size and date) was already sent, and only the partial uploads of the same local file are resumed.
         """
         if not settings.has_option(section, 'host') or not settings.has_option(section, 'user') or not settings.has_option(section, 'password'):
             return False
@@ -286,17 +851,199 @@ class SyncBackup:
             print DBG_MSG + "* FTP -> " + host + " (" + user + ")\n  " + "\n  ".join([x[0] for x in seqfiles]) + DBG_MSG_END
             return True
 
-        session = ftplib.FTP(host, user, password)
-        for f in seqfiles:
-            filename = os.path.basename(f[0])
+        state_file = os.path.join(settings.get('default', 'output'), 'distbackup.ftp')
+        state = {}
+        if os.path.isfile(state_file):
+            try:
+                f = open(state_file, 'r')
+                state = json.load(f)
+                f.close()
+            except (OSError, IOError, ValueError):
+                state = {}
+        sent = state.setdefault(host, {})
+        lock = threading.Lock()
+
+        def record(filename, entry):
+            with lock:
+                sent[filename] = entry
+                f = open(state_file + '.tmp', 'w')
+                json.dump(state, f, indent=1)
+                f.close()
+                os.rename(state_file + '.tmp', state_file)
+
+        def remoteSize(session, filename):
+            try:
+                return session.size(filename)
+            except ftplib.error_perm:
+                return None
+
+        def sendFiles(files):
+            session = ftplib.FTP(host, user, password)
+            session.voidcmd('TYPE I')
+            for f in files:
+                filename = os.path.basename(f)
+                st = os.stat(f)
+                local = {'size': st.st_size, 'mtime': st.st_mtime}
+                previous = sent.get(filename, {})
+                same = previous.get('size') == local['size'] and previous.get('mtime') == local['mtime']
+
+                # Already sent by a previous run
+                if same and previous.get('status') == 'done' and remoteSize(session, filename) == local['size']:
+                    continue
+
+                # Resume the upload of the same local file
+                offset = 0
+                if same and previous.get('status') == 'partial':
+                    offset = remoteSize(session, filename + '.part') or 0
+                    if offset > local['size']:
+                        offset = 0
+
+                record(filename, dict(local, status='partial'))
+                file = open(f, 'rb')
+                if offset > 0:
+                    file.seek(offset)
+                    session.storbinary('STOR ' + filename + '.part', file, rest=offset)
+                else:
+                    session.storbinary('STOR ' + filename + '.part', file)
+                file.close()
+                try:
+                    session.delete(filename)
+                except ftplib.error_perm:
+                    pass
+                session.rename(filename + '.part', filename)
+                record(filename, dict(local, status='done'))
+
+            session.quit()
+
+        # One FTP session per worker
+        workers = SyncBackup.parallel(settings, section)
+        files = [x[0] for x in seqfiles]
+        try:
+            parallel_map(sendFiles, [files[i::workers] for i in range(workers) if files[i::workers]], workers)
+        except ftplib.all_errors as err:
+            raise BackupError("FTP transfer to " + host + " failed: " + str(err))
+        return True
+
+    @staticmethod
+    def processS3(settings, section, seqfiles):
+        """S3 handler
+
+        Upload the files in an S3 compatible object storage (AWS, MinIO, Ceph...).
+        The big files are sent with a parallel multipart upload, each part being retried.
+        The objects keep the MD5 of the file in their metadata, so unchanged files are skipped.
+        """
+        if not settings.has_option(section, 'bucket'):
+            return False
+        bucket = settings.get(section, 'bucket')
 
-            file = open(f[0], 'rb')
-            session.storbinary('STOR ' + filename, file)
-            file.close()
+        def option(key, default=None):
+            if settings.has_option(section, key):
+                return settings.get(section, key).strip()
+            return default
+
+        prefix = option('prefix', '').strip('/')
+        part_size = max(parse_size(option('part_size', '64M')), 5 * 1024 * 1024)
+        retries = int(option('retries', '3'))
+        workers = SyncBackup.parallel(settings, section)
+
+        def objectKey(f, group):
+            return '/'.join([x for x in [prefix, group.strip('/'), os.path.basename(f)] if x != ''])
+
+        # Debug mode
+        if debug:
+            print DBG_MSG + "* S3 -> " + bucket + "\n  " + "\n  ".join([x[0] + " -> " + objectKey(x[0], x[2]) for x in seqfiles]) + DBG_MSG_END
+            return True
+
+        try:
+            import boto3
+        except ImportError:
+            raise BackupError("The s3 protocol needs the boto3 module")
+
+        client = boto3.session.Session().client(
+            's3',
+            endpoint_url=option('endpoint'),
+            region_name=option('region'),
+            aws_access_key_id=option('access_key'),
+            aws_secret_access_key=option('secret_key')
+        )
+
+        def retry(function, *args, **kwargs):
+            for delay in [1, 2, 4, 8, 16][:retries]:
+                try:
+                    return function(*args, **kwargs)
+                except Exception:
+                    time.sleep(delay)
+            return function(*args, **kwargs)
+
+        def readPart(f, offset, size):
+            fd = open(f, 'rb')
+            fd.seek(offset)
+            data = fd.read(size)
+            fd.close()
+            return data
+
+        def upload(item):
+            (f, file_section, group) = item
+            key = objectKey(f, group)
+            size = os.path.getsize(f)
+            md5_hash = generate_file_md5('', f)
+
+            # Skip the objects already uploaded
+            try:
+                head = client.head_object(Bucket=bucket, Key=key)
+                if head.get('Metadata', {}).get('md5') == md5_hash:
+                    return
+            except Exception:
+                pass
+
+            params = {
+                'Bucket': bucket,
+                'Key': key,
+                'Metadata': {'md5': md5_hash}
+            }
+            storage_class = option('storage_class.' + group.strip('/'), option('storage_class'))
+            if storage_class:
+                params['StorageClass'] = storage_class
+
+            if size <= part_size:
+                retry(client.put_object, Body=readPart(f, 0, size), **params)
+                return
+
+            # Multipart upload (S3 accepts at most 10000 parts)
+            file_part_size = max(part_size, (size + 9999) // 10000)
+            upload_id = client.create_multipart_upload(**params)['UploadId']
+
+            def uploadPart(number):
+                data = readPart(f, (number - 1) * file_part_size, file_part_size)
+                ret = retry(client.upload_part, Bucket=bucket, Key=key, UploadId=upload_id, PartNumber=number, Body=data)
+                return {'PartNumber': number, 'ETag': ret['ETag']}
+
+            try:
+                parts = parallel_map(uploadPart, range(1, (size + file_part_size - 1) // file_part_size + 1), workers)
+                client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id, MultipartUpload={'Parts': parts})
+            except Exception:
+                client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+                raise
+
+        # The small files (volumes) are sent in parallel, the big ones one after the other with parallel parts
+        files = [x for x in seqfiles if os.path.isfile(x[0])]
+        try:
+            parallel_map(upload, [x for x in files if os.path.getsize(x[0]) <= part_size], workers)
+            for item in [x for x in files if os.path.getsize(x[0]) > part_size]:
+                upload(item)
+        except Exception as err:
+            raise BackupError("S3 upload to " + bucket + " failed: " + str(err))
 
-        session.quit()
         return True
 
+    @staticmethod
+    def parallel(settings, section):
+        """Number of simultaneous transfers for a sync section
+        """
+        if not settings.has_option(section, 'parallel'):
+            return 1
+        return max(1, int(settings.get(section, 'parallel').strip()))
+
     @staticmethod
     def copy(source, dest):
         # Debug mode
@@ -310,6 +1057,341 @@ class SyncBackup:
 #
 #
 #
+class DeltaArchive:
+    """Binary delta archive of database dumps
+
+    A dump is archived in full ('name_DATE.gz') every 'delta_full_days' days.
+    The other days, only a xdelta3 delta between the uncompressed dump and the previous one is stored ('name_DATE.xd3').
+    The previous uncompressed dump is kept in the '.delta' folder of the group.
+    """
+
+    @staticmethod
+    def chain(folder, name):
+        """List the archives (date, path, is_full) of a dump, sorted by date
+        """
+        ret = []
+        if not os.path.isdir(folder):
+            return ret
+        for f in os.listdir(folder):
+            match = DATE_REG.search(f)
+            if match == None or match.start() != len(name) or not f.startswith(name):
+                continue
+            ext = f[match.end() - 1:]
+            if not ext in ['.gz', '.xd3']:
+                continue
+            date = '-'.join(match.groups())
+            ret.append((date, os.path.join(folder, f), ext == '.gz'))
+        return sorted(ret)
+
+    @staticmethod
+    def archive(source, folder, name, date, full_days):
+        """Archive a gzip dump as a full file or as a delta of the previous dump
+        """
+        cache = os.path.join(folder, '.delta', name + '.last')
+        full = os.path.join(folder, name + '_' + date + '.gz')
+        delta = os.path.join(folder, name + '_' + date + '.xd3')
+
+        chain = DeltaArchive.chain(folder, name)
+        fulls = [x for x in chain if x[2]]
+        need_full = len(fulls) == 0 or not os.path.isfile(cache) or chain[-1][0] >= date
+        if not need_full:
+            last_full = datetime.datetime.strptime(fulls[-1][0], "%Y-%m-%d")
+            need_full = (datetime.datetime.strptime(date, "%Y-%m-%d") - last_full).days >= full_days
+
+        if debug:
+            print DBG_MSG + "* Archive " + source + " -> " + (full if need_full else delta) + DBG_MSG_END
+            return True
+
+        if not os.path.isdir(os.path.dirname(cache)):
+            os.makedirs(os.path.dirname(cache))
+
+        # Uncompressed dump, which will be the base of the next delta
+        tmp = cache + '.new'
+        src = gzip.open(source, 'rb')
+        dst = open(tmp, 'wb')
+        shutil.copyfileobj(src, dst, 2**20)
+        dst.close()
+        src.close()
+
+        if not need_full:
+            try:
+                err = subprocess.call(['xdelta3', '-e', '-f', '-s', cache, tmp, delta])
+            except OSError:
+                err = -1
+            if err != 0:
+                print "Cannot create the delta of " + source + " with xdelta3, it is archived in full"
+                if os.path.exists(delta):
+                    os.remove(delta)
+                need_full = True
+
+        if need_full:
+            if os.path.exists(delta):
+                os.remove(delta)
+            SyncBackup.copy(source, full)
+
+        os.rename(tmp, cache)
+        return True
+
+    @staticmethod
+    def restore(path, output):
+        """Rebuild the uncompressed dump of an archive (full or delta) into an output stream
+        """
+        folder, filename = os.path.split(os.path.abspath(path))
+        match = DATE_REG.search(filename)
+        if match == None:
+            return False
+        name = filename[:match.start()]
+        date = '-'.join(match.groups())
+
+        chain = [x for x in DeltaArchive.chain(folder, name) if x[0] <= date]
+        if len(chain) == 0 or chain[-1][0] != date:
+            return False
+        fulls = [i for i, x in enumerate(chain) if x[2]]
+        if len(fulls) == 0:
+            return False
+        chain = chain[fulls[-1]:]
+
+        tmp_folder = tempfile.mkdtemp()
+        try:
+            current = os.path.join(tmp_folder, chain[0][0])
+            src = gzip.open(chain[0][1], 'rb')
+            dst = open(current, 'wb')
+            shutil.copyfileobj(src, dst, 2**20)
+            dst.close()
+            src.close()
+
+            # Apply the deltas
+            for day, delta, is_full in chain[1:]:
+                target = os.path.join(tmp_folder, day)
+                try:
+                    if subprocess.call(['xdelta3', '-d', '-f', '-s', current, delta, target]) != 0:
+                        return False
+                except OSError:
+                    sys.stderr.write("Cannot run xdelta3\n")
+                    return False
+                os.remove(current)
+                current = target
+
+            src = open(current, 'rb')
+            shutil.copyfileobj(src, output, 2**20)
+            src.close()
+        finally:
+            shutil.rmtree(tmp_folder)
+        return True
+
+#
+#
+#
+class Catalog:
+    """Catalog of the archives content
+
+    For each member of each archived tar or zip file, the catalog stores its path, size, date and MD5
+    in a SQLite database (in the archive folder by default, 'catalog' setting of the 'default' section).
+    It allows to find which archive holds a file, and its history.
+    """
+
+    def __init__(self, settings):
+        self.db = sqlite3.connect(Catalog.filename(settings))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS archives (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE,
+                grp TEXT,
+                date TEXT
+            );
+            CREATE TABLE IF NOT EXISTS members (
+                archive INTEGER,
+                path TEXT,
+                size INTEGER,
+                mtime INTEGER,
+                md5 TEXT
+            );
+            CREATE INDEX IF NOT EXISTS members_path ON members (path);
+            CREATE INDEX IF NOT EXISTS members_archive ON members (archive);
+        ''')
+
+    @staticmethod
+    def filename(settings):
+        if settings.has_option('default', 'catalog'):
+            return settings.get('default', 'catalog')
+        return os.path.join(settings.get('default', 'archive'), 'catalog.sqlite')
+
+    @staticmethod
+    def existing(settings):
+        """Open the catalog if it has already been created
+        """
+        if not os.path.isfile(Catalog.filename(settings)):
+            return None
+        return Catalog(settings)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    @staticmethod
+    def members(path):
+        """Yield (path, size, mtime, md5) for each file of an archive (or of a volume set)
+        """
+        volumes = sorted(glob.glob(path + '.[0-9][0-9][0-9]'))
+        if path.endswith('.zip'):
+            if len(volumes) > 0:
+                return
+            archive = zipfile.ZipFile(path, 'r')
+            for info in archive.infolist():
+                if info.filename.endswith('/') or stat.S_ISLNK(info.external_attr >> 16):
+                    continue
+                m = hashlib.md5()
+                f = archive.open(info)
+                while True:
+                    buf = f.read(2**20)
+                    if not buf:
+                        break
+                    m.update(buf)
+                f.close()
+                mtime = time.mktime(info.date_time + (0, 0, -1))
+                yield '/' + info.filename, info.file_size, int(mtime), m.hexdigest()
+            archive.close()
+            return
+
+        fileobj = ConcatFile(volumes if len(volumes) > 0 else [path])
+        archive = tarfile.open(fileobj=fileobj, mode='r|*')
+        # Size and MD5 of the files, for the hard links to them
+        targets = {}
+        for info in archive:
+            if info.islnk():
+                if info.linkname in targets:
+                    size, md5_hash = targets[info.linkname]
+                    yield '/' + info.name, size, int(info.mtime), md5_hash
+                continue
+            if not info.isreg():
+                continue
+            m = hashlib.md5()
+            f = archive.extractfile(info)
+            while True:
+                buf = f.read(2**20)
+                if not buf:
+                    break
+                m.update(buf)
+            targets[info.name] = (info.size, m.hexdigest())
+            yield '/' + info.name, info.size, int(info.mtime), m.hexdigest()
+        archive.close()
+        fileobj.close()
+
+    def index(self, path, group, date):
+        """Add the content of an archive (replacing a previous index of the same file)
+        """
+        if not re.search(r'\.(tar\.gz|tar\.bz2|tar|tgz|zip)$', path):
+            return
+        self.remove(path)
+        cursor = self.db.execute('INSERT INTO archives (path, grp, date) VALUES (?, ?, ?)', (path, group, date))
+        archive_id = cursor.lastrowid
+        try:
+            self.db.executemany(
+                'INSERT INTO members (archive, path, size, mtime, md5) VALUES (?, ?, ?, ?, ?)',
+                ((archive_id,) + x for x in Catalog.members(path))
+            )
+        except (tarfile.TarError, zipfile.BadZipfile, OSError, IOError):
+            print "Cannot index archive " + path
+        self.db.commit()
+
+    def remove(self, path):
+        for row in self.db.execute('SELECT id FROM archives WHERE path = ?', (path,)).fetchall():
+            self.db.execute('DELETE FROM members WHERE archive = ?', row)
+            self.db.execute('DELETE FROM archives WHERE id = ?', row)
+
+    def rename(self, path, new_path):
+        self.db.execute('UPDATE archives SET path = ? WHERE path = ?', (new_path, path))
+
+    def find(self, pattern, date=None):
+        """Files matching a pattern, in the latest archive (before a date)
+        """
+        if not pattern.startswith('/') and not pattern.startswith('*'):
+            pattern = '*' + pattern
+        query = '''
+            SELECT a.date, m.path, m.size, m.mtime, m.md5, a.path
+            FROM members m JOIN archives a ON a.id = m.archive
+            WHERE m.path GLOB ? AND a.date = (
+                SELECT MAX(a2.date) FROM members m2 JOIN archives a2 ON a2.id = m2.archive
+                WHERE m2.path = m.path AND a2.date <= ?
+            )
+            ORDER BY m.path
+        '''
+        return self.db.execute(query, (pattern, date or '9999-99-99')).fetchall()
+
+    def history(self, path):
+        """All the archived versions of a file
+        """
+        query = '''
+            SELECT a.date, m.path, m.size, m.mtime, m.md5, a.path
+            FROM members m JOIN archives a ON a.id = m.archive
+            WHERE m.path = ?
+            ORDER BY a.date
+        '''
+        return self.db.execute(query, ('/' + path.lstrip('/'),)).fetchall()
+
+    def stats(self):
+        """Deduplication statistics: (archives, files, total size, unique files, unique size)
+        """
+        archives = self.db.execute('SELECT COUNT(*) FROM archives').fetchone()[0]
+        files, size = self.db.execute('SELECT COUNT(*), SUM(size) FROM members').fetchone()
+        unique, unique_size = self.db.execute('SELECT COUNT(*), SUM(size) FROM (SELECT md5, MAX(size) AS size FROM members GROUP BY md5)').fetchone()
+        return archives, files, size or 0, unique, unique_size or 0
+
+#
+#
+#
+class ConcatFile:
+    """Read several files as a single stream (volumes of a backup)
+    """
+
+    def __init__(self, files):
+        self.files = list(files)
+        self.current = None
+
+    def read(self, size=-1):
+        data = ''
+        while size < 0 or len(data) < size:
+            if self.current == None:
+                if len(self.files) == 0:
+                    break
+                self.current = open(self.files.pop(0), 'rb')
+            buf = self.current.read(size - len(data) if size >= 0 else -1)
+            if not buf:
+                self.current.close()
+                self.current = None
+                continue
+            data += buf
+        return data
+
+    def close(self):
+        if self.current != None:
+            self.current.close()
+            self.current = None
+
+#
+#
+#
+class ScanFile:
+    """Read a stream, searching a regular expression in its beginning (the 'limit' first bytes)
+    """
+
+    def __init__(self, f, reg, limit=2**20):
+        self.f = f
+        self.reg = reg
+        self.limit = limit
+        self.head = ''
+        self.match = None
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        if self.match == None and len(self.head) < self.limit:
+            self.head += data[:self.limit - len(self.head)]
+            self.match = self.reg.search(self.head)
+        return data
+
+#
+#
+#
 class SvnBackup:
     """Subversion Backup class
 
@@ -323,11 +1405,14 @@ class SvnBackup:
             return False
         folder = settings.get(section, 'folder')
         if not os.path.exists(folder):
-            return False
+            raise BackupError("Folder not found: " + folder)
 
         archive_format = 'tar.gz'
         archive_format_parameter = '--gzip' # --bzip2
 
+        # With the adaptive compression, tar gives an uncompressed stream
+        adaptive = adaptiveCompression(settings, section)
+
         output_folder = settings.get('default', 'output')
         output_filename = settings.get(section, 'output') + '.' + archive_format
         output_file = os.path.join(output_folder, output_filename)
@@ -349,11 +1434,13 @@ class SvnBackup:
             '--ignore-failed-read',
             archive_format_parameter,
             '-cf',
-            output_file,
+            '-',
             '-C',
             '/',
             svn_folder.lstrip('/')
         ]
+        if adaptive:
+            params.remove(archive_format_parameter)
 
         # Debug mode
         if debug:
@@ -361,7 +1448,9 @@ class SvnBackup:
             return { 'file': output_file }
 
         # Processing the backup
-        ret = subprocess.call(params)
+        tar = subprocess.Popen(params, stdout=subprocess.PIPE)
+        ret = writeOutput(settings, section, output_file, tar.stdout, compress=adaptive)
+        code = tar.wait()
 
         # Clean the temp SVN folder is needed
         if folder != svn_folder:
@@ -370,10 +1459,9 @@ class SvnBackup:
             else:
                 os.remove(old_backup_item)
 
-        #
-        return {
-            'file': output_file
-        }
+        # tar exits with 1 when files changed during the archive
+        checkExit('tar', code, 1)
+        return ret
 
     @staticmethod
     def hotcopy(folder, settings, section):
@@ -475,28 +1563,860 @@ class ReportBackup:
         else:
             disks = settings.get(section, 'disks').split(',')
 
-        if len(disks) == 0:
-            return False
+        if len(disks) == 0:
+            return False
+
+        ret = "%-10s %8s %8s %8s %8s" % ( "Disk", "Size", "Used", "Avail", "Use%" )
+        for disk in disks:
+            try:
+                status = os.statvfs(disk.strip(' '))
+            except (OSError, IOError):
+                print disk
+                status = False
+
+            if status == False or status.f_blocks == 0:
+                continue
+
+            free = status.f_bfree * status.f_frsize
+            size = status.f_blocks * status.f_frsize
+            avail = status.f_bavail * status.f_frsize
+            used = (status.f_blocks - status.f_bfree) * status.f_frsize
+            used_percent = str( round(100. * used / size, 1) ) + '%'
+
+            ret += "\n%-10s %8s %8s %8s %8s" % ( disk, sizeof_fmt(size, ''), sizeof_fmt(used, ''), sizeof_fmt(avail, ''), used_percent )
+        return ret
+
+#
+#
+#
+class ExcludeRules:
+    """Exclusion rules of a folder backup
+
+    The patterns use the gitignore syntax and are compiled once.
+    They come from the 'exclude' setting and from the ignore files ('exclude_file')
+    found in the backuped folder, which apply to their own sub-tree.
+    Files can also be filtered on their size ('max_file_size') or their age ('modified_within'),
+    and the cache directories (with a CACHEDIR.TAG file) can be skipped ('exclude_caches').
+    """
+
+    CACHEDIR_SIGNATURE = 'Signature: 8a477f597d28d172789f06886806bc55'
+
+    def __init__(self, settings, section):
+        self.patterns = []
+        if settings.has_option(section, 'exclude'):
+            self.patterns = [x.strip(' ') for x in settings.get(section, 'exclude').split(',') if x.strip(' ')]
+        if len(self.patterns) == 0 and settings.has_option('default', 'exclude'):
+            self.patterns = [x.strip(' ') for x in settings.get('default', 'exclude').split(',') if x.strip(' ')]
+        self.rules = ExcludeRules.compileAll(self.patterns)
+
+        self.ignore_file = ExcludeRules.option(settings, section, 'exclude_file')
+
+        self.max_size = 0
+        if ExcludeRules.option(settings, section, 'max_file_size'):
+            self.max_size = parse_size(ExcludeRules.option(settings, section, 'max_file_size'))
+
+        self.min_mtime = 0
+        if ExcludeRules.option(settings, section, 'modified_within'):
+            days = float(ExcludeRules.option(settings, section, 'modified_within'))
+            self.min_mtime = time.time() - days * 86400
+
+        self.exclude_caches = (ExcludeRules.option(settings, section, 'exclude_caches') or '').lower().strip() == 'true'
+
+        # Statistics of the walk
+        self.files = 0
+        self.bytes = 0
+
+    @staticmethod
+    def option(settings, section, key):
+        """Value of a setting in the section or in the 'default' section
+        """
+        if settings.has_option(section, key):
+            return settings.get(section, key)
+        if settings.has_option('default', key):
+            return settings.get('default', key)
+        return None
+
+    @staticmethod
+    def compile(pattern):
+        """Compile a gitignore pattern
+
+        Return a tuple (regex, negate, dir_only) or None for an empty line or a comment.
+        The regex matches a path relative to the folder of the pattern.
+        """
+        pattern = pattern.rstrip(' \r\n')
+        if pattern == '' or pattern.startswith('#'):
+            return None
+
+        negate = False
+        if pattern.startswith('!'):
+            negate = True
+            pattern = pattern[1:]
+        elif pattern.startswith('\\#') or pattern.startswith('\\!'):
+            pattern = pattern[1:]
+
+        dir_only = pattern.endswith('/')
+        pattern = pattern.rstrip('/')
+        if pattern == '':
+            return None
+
+        # A pattern without slash matches at any depth
+        regex = ''
+        if not '/' in pattern:
+            regex = '(?:.*/)?'
+        pattern = pattern.lstrip('/')
+
+        i = 0
+        n = len(pattern)
+        while i < n:
+            c = pattern[i]
+            if pattern.startswith('**/', i):
+                regex += '(?:.*/)?'
+                i += 3
+                continue
+            if pattern.startswith('**', i):
+                regex += '.*'
+                i += 2
+                continue
+            if c == '*':
+                regex += '[^/]*'
+            elif c == '?':
+                regex += '[^/]'
+            elif c == '[':
+                j = pattern.find(']', i + 2)
+                if j < 0:
+                    regex += '\\['
+                else:
+                    chars = pattern[i + 1:j].replace('\\', '\\\\')
+                    if chars.startswith('!'):
+                        chars = '^' + chars[1:]
+                    regex += '[' + chars + ']'
+                    i = j
+            elif c == '\\' and i + 1 < n:
+                i += 1
+                regex += re.escape(pattern[i])
+            else:
+                regex += re.escape(c)
+            i += 1
+
+        # Matching a folder also matches its content
+        return (re.compile(regex + '(?:/.*)?$'), negate, dir_only)
+
+    @staticmethod
+    def compileAll(patterns):
+        rules = []
+        for pattern in patterns:
+            rule = ExcludeRules.compile(pattern)
+            if rule != None:
+                rules.append(rule)
+        return rules
+
+    @staticmethod
+    def excluded(path, is_dir, stack):
+        """Test a path (relative to the backuped folder) against the stacked rules
+
+        The last matching rule wins, like with git.
+        """
+        ret = False
+        for base, rules in stack:
+            sub = path[len(base):]
+            for regex, negate, dir_only in rules:
+                if dir_only and not is_dir:
+                    continue
+                if regex.match(sub):
+                    ret = not negate
+        return ret
+
+    def isCache(self, path):
+        """Test if a directory is tagged as a cache (http://www.brynosaurus.com/cachedir/)
+        """
+        try:
+            f = open(os.path.join(path, 'CACHEDIR.TAG'), 'rb')
+            signature = f.read(len(ExcludeRules.CACHEDIR_SIGNATURE))
+            f.close()
+        except (OSError, IOError):
+            return False
+        return signature == ExcludeRules.CACHEDIR_SIGNATURE
+
+    def readIgnoreFile(self, path):
+        try:
+            f = open(path, 'r')
+            lines = f.readlines()
+            f.close()
+        except (OSError, IOError):
+            return []
+        return ExcludeRules.compileAll(lines)
+
+    def walk(self, folder):
+        """Walk a folder and yield (path, lstat) for each entry to backup
+
+        The folders are yielded before their content.
+        Excluded folders are pruned and never read.
+        """
+        folder = folder.rstrip('/') or '/'
+        try:
+            yield folder, os.lstat(folder)
+        except OSError:
+            return
+
+        todo = [(folder, '', [('', self.rules)])]
+        while len(todo) > 0:
+            path, rel, stack = todo.pop()
+            try:
+                entries = scanFolder(path)
+            except OSError:
+                continue
+
+            # Ignore file of that folder
+            if self.ignore_file and self.ignore_file in [x[0] for x in entries]:
+                rules = self.readIgnoreFile(os.path.join(path, self.ignore_file))
+                if len(rules) > 0:
+                    stack = stack + [(rel, rules)]
+
+            subfolders = []
+            for name, is_dir in entries:
+                fullname = os.path.join(path, name)
+
+                # The type given by scandir avoids the stat of the excluded entries
+                st = None
+                if is_dir == None:
+                    try:
+                        st = os.lstat(fullname)
+                    except OSError:
+                        continue
+                    is_dir = stat.S_ISDIR(st.st_mode)
+
+                if ExcludeRules.excluded(rel + name, is_dir, stack):
+                    continue
+                if is_dir and self.exclude_caches and self.isCache(fullname):
+                    continue
+                if st == None:
+                    try:
+                        st = os.lstat(fullname)
+                    except OSError:
+                        continue
+
+                if is_dir:
+                    subfolders.append((fullname, rel + name + '/', stack))
+                elif stat.S_ISREG(st.st_mode):
+                    if self.max_size > 0 and st.st_size > self.max_size:
+                        continue
+                    if self.min_mtime > 0 and st.st_mtime < self.min_mtime:
+                        continue
+                    self.files += 1
+                    self.bytes += st.st_size
+                yield fullname, st
+
+            subfolders.reverse()
+            todo.extend(subfolders)
+
+#
+#
+#
+def scanFolder(path):
+    """List a folder as (name, is_dir) tuples, sorted by name
+
+    is_dir comes from scandir when available, otherwise it is None (unknown).
+    """
+    if scandir != None:
+        entries = [(entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(path)]
+    else:
+        entries = [(name, None) for name in os.listdir(path)]
+    entries.sort()
+    return entries
+
+#
+#
+#
+class ReadAhead:
+    """Read-ahead of the files of a folder walk
+
+    The entries are taken by batches in which the files are sorted by inode number
+    (which mostly follows their place on the disk).
+    The content of the small files is then read in advance by a pool of threads,
+    so the archiver is not waiting for the disk.
+    Iterating gives (path, lstat, data) with data set to None for the folders, links and big files.
+    With keep=False, the files are only read to fill the page cache (for the tar command)
+    and data is always None.
+    """
+
+    def __init__(self, entries, threads=8, batch=4096, max_size=256*1024, keep=True):
+        self.entries = entries
+        self.threads = max(1, threads)
+        self.batch = batch
+        self.max_size = max_size
+        self.keep = keep
+
+    def batches(self):
+        """Yield the entries, sorted by inode in each batch
+        """
+        batch = []
+        for path, st in self.entries:
+            batch.append((path, st))
+            if len(batch) >= self.batch:
+                batch.sort(key=lambda x: (not stat.S_ISDIR(x[1].st_mode), x[1].st_ino))
+                for x in batch:
+                    yield x
+                batch = []
+        batch.sort(key=lambda x: (not stat.S_ISDIR(x[1].st_mode), x[1].st_ino))
+        for x in batch:
+            yield x
+
+    @staticmethod
+    def read(path, keep=True):
+        try:
+            f = open(path, 'rb')
+            if keep:
+                data = f.read()
+            else:
+                data = None
+                while f.read(2**16):
+                    pass
+            f.close()
+        except (OSError, IOError):
+            return None
+        return data
+
+    def __iter__(self):
+        tasks = Queue.Queue()
+
+        # The small files are read by groups, to limit the synchronization cost
+        def worker():
+            while True:
+                task = tasks.get()
+                if task == None:
+                    return
+                paths, slot = task
+                slot.put([ReadAhead.read(path, self.keep) for path in paths])
+
+        workers = [threading.Thread(target=worker) for x in range(self.threads)]
+        for t in workers:
+            t.daemon = True
+            t.start()
+
+        group_size = 32
+        window = self.threads * 4
+        pending = collections.deque()
+        group = []
+
+        def submit():
+            slot = Queue.Queue(1)
+            tasks.put(([x[0] for x in group if x[2]], slot))
+            pending.append((group, slot))
+
+        def pop():
+            entries, slot = pending.popleft()
+            datas = slot.get()
+            i = 0
+            for path, st, small in entries:
+                data = None
+                if small:
+                    data = datas[i]
+                    i += 1
+                yield path, st, data
+
+        try:
+            for path, st in self.batches():
+                small = stat.S_ISREG(st.st_mode) and st.st_size <= self.max_size
+                group.append((path, st, small))
+                if len(group) >= group_size:
+                    submit()
+                    group = []
+                while len(pending) > window:
+                    for x in pop():
+                        yield x
+            if len(group) > 0:
+                submit()
+            while len(pending) > 0:
+                for x in pop():
+                    yield x
+        finally:
+            for t in workers:
+                tasks.put(None)
+
+#
+#
+#
+class CompressThread:
+    """File-like object giving its data to a compressor (gzip) in a dedicated thread
+
+    An error of the compressor (disk full...) is raised in the main thread as a BackupError.
+    """
+
+    def __init__(self, gz, blocksize=2**20):
+        self.gz = gz
+        self.blocksize = blocksize
+        self.buffer = []
+        self.buffered = 0
+        self.error = None
+        self.closed = False
+        self.queue = Queue.Queue(8)
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        # After an error (disk full...), the queue is still emptied so the main thread is never blocked
+        while True:
+            data = self.queue.get()
+            if data == None:
+                break
+            if self.error != None:
+                continue
+            try:
+                self.gz.write(data)
+            except Exception as err:
+                self.error = err
+        if self.error == None:
+            try:
+                self.gz.close()
+            except Exception as err:
+                self.error = err
+
+    def write(self, data):
+        if self.error != None or self.closed:
+            self.close()
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.blocksize:
+            self.queue.put(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        # Nothing is given to the thread once it has stopped
+        if not self.closed:
+            self.closed = True
+            if len(self.buffer) > 0:
+                self.queue.put(''.join(self.buffer))
+                self.buffer = []
+            self.queue.put(None)
+            self.thread.join()
+
+        # The error is raised once (the tar stream closes its file again when deleted)
+        if self.error != None:
+            error = self.error
+            self.error = None
+            raise BackupError("Cannot write the archive: " + str(error))
+
+#
+#
+#
+class AdaptiveGzip:
+    """Gzip compression whose level follows the backup window
+
+    The data is compressed by chunks, each one in its own gzip member (a concatenation of members is a valid gzip file).
+    The level of each chunk is the densest one which lets the section end in its time budget,
+    from the remaining input (the size of the previous run) and the measured speeds:
+    the speed of each level is measured on a sample, then corrected with the speed of the compressed chunks.
+    """
+
+    def __init__(self, fileobj, budget=None, expected=0, level=6, chunk_size=16*2**20, sample_size=256*1024):
+        self.fileobj = fileobj
+        self.name = os.path.basename(fileobj.name)
+        self.budget = budget
+        self.expected = expected
+        self.default = level
+        self.chunk_size = chunk_size
+        self.sample_size = sample_size
+        self.speeds = None
+        self.levels = {}
+        self.gz = None
+        self.level = None
+        self.input = 0
+        self.chunk_input = 0
+        self.chunk_time = 0.0
+        self.waited = 0.0
+        self.start = time.time()
+        self.last = self.start
+
+    def calibrate(self, sample):
+        """Compression time (seconds per byte) of each level, on a sample of the data
+        """
+        self.speeds = {}
+        for level in range(1, 10):
+            before = time.time()
+            zlib.compress(sample, level)
+            self.speeds[level] = max(time.time() - before, 1e-6) / len(sample)
+
+    def choose(self):
+        """Level of the next chunk
+        """
+        if self.budget == None:
+            return self.default
+        left = self.budget - (time.time() - self.start)
+
+        # Without previous run, the remaining input is supposed to be as large as the processed one
+        remaining = self.chunk_size
+        if self.expected > 0:
+            remaining = max(remaining, self.expected - self.input)
+        else:
+            remaining = max(remaining, self.input)
+
+        # Time spent to produce the data (tar, dump) and to compress it
+        source = 0
+        if self.input > 0:
+            source = self.waited / self.input
+        for level in range(9, 0, -1):
+            if remaining * (source + self.speeds[level]) <= left:
+                return level
+        return 1
+
+    def endChunk(self):
+        self.gz.close()
+        self.gz = None
+        self.levels[self.level] = self.levels.get(self.level, 0) + self.chunk_input
+
+        # The speeds of the data are not the ones of the sample
+        if self.chunk_input >= self.sample_size:
+            factor = (self.chunk_time / self.chunk_input) / self.speeds[self.level]
+            for level in self.speeds:
+                self.speeds[level] *= factor
+
+    def write(self, data):
+        now = time.time()
+        self.waited += now - self.last
+        if self.gz == None:
+            if self.speeds == None:
+                self.calibrate(data[:self.sample_size])
+            self.level = self.choose()
+            self.gz = gzip.GzipFile(self.name, 'wb', self.level, self.fileobj)
+            self.chunk_input = 0
+            self.chunk_time = 0.0
+            now = time.time()
+        self.gz.write(data)
+        self.input += len(data)
+        self.chunk_input += len(data)
+        self.last = time.time()
+        self.chunk_time += self.last - now
+        if self.chunk_input >= self.chunk_size:
+            self.endChunk()
+
+    def close(self):
+        if self.gz != None:
+            self.endChunk()
+
+    def result(self):
+        """Compression levels used (uncompressed bytes per level)
+        """
+        return {
+            'levels': dict([(str(k), v) for k, v in self.levels.items()]),
+            'input': self.input,
+            'budget': self.budget
+        }
+
+#
+#
+#
+class TarArchive:
+    """In-process tar.gz archive of a folder
+
+    The files are read with a ReadAhead ('read_threads' threads),
+    the main thread builds the tar stream and another thread compresses it.
+    Like tar, the hard links, FIFOs and device files are archived, and the sockets are ignored.
+    """
+
+    @staticmethod
+    def write(settings, section, folder, rules, gz):
+        """Write the tar archive of a folder into the output compressor
+        """
+        threads = 8
+        if settings.has_option(section, 'read_threads'):
+            threads = int(settings.get(section, 'read_threads').strip())
+
+        gz = CompressThread(gz)
+        archive = tarfile.open(fileobj=gz, mode='w|', format=tarfile.GNU_FORMAT)
+        links = {}
+        for path, st, data in ReadAhead(rules.walk(folder), threads):
+            info = TarArchive.tarinfo(path, st)
+            if info == None:
+                print "Cannot archive " + path + " (socket or unreadable link)"
+                continue
+
+            # The next names of a file with several hard links are links to the first one
+            if info.type == tarfile.REGTYPE and st.st_nlink > 1:
+                key = (st.st_dev, st.st_ino)
+                if links.has_key(key):
+                    info.type = tarfile.LNKTYPE
+                    info.linkname = links[key]
+                    info.size = 0
+                else:
+                    links[key] = info.name
+
+            # Only the read errors of the files are ignored (not the errors of the archive)
+            if info.type == tarfile.REGTYPE and data != None:
+                info.size = len(data)
+                archive.addfile(info, StringIO.StringIO(data))
+            elif info.type == tarfile.REGTYPE:
+                try:
+                    f = open(path, 'rb')
+                except (OSError, IOError):
+                    print "Cannot read file " + path
+                    if links.get((st.st_dev, st.st_ino)) == info.name:
+                        del links[(st.st_dev, st.st_ino)]
+                    continue
+                padded = PaddedFile(f, info.size)
+                archive.addfile(info, padded)
+                f.close()
+                if padded.error != None:
+                    print "Cannot read file " + path
+            else:
+                archive.addfile(info)
+        archive.close()
+        gz.close()
+
+    @staticmethod
+    def tarinfo(path, st):
+        """Build the tar header of an entry from its lstat (without another stat call)
+        """
+        info = tarfile.TarInfo(path.lstrip('/') or '.')
+        info.mode = stat.S_IMODE(st.st_mode)
+        info.uid = st.st_uid
+        info.gid = st.st_gid
+        info.mtime = st.st_mtime
+        info.uname = TarArchive.uname(st.st_uid)
+        info.gname = TarArchive.gname(st.st_gid)
+        if stat.S_ISREG(st.st_mode):
+            info.type = tarfile.REGTYPE
+            info.size = st.st_size
+        elif stat.S_ISDIR(st.st_mode):
+            info.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(st.st_mode):
+            info.type = tarfile.SYMTYPE
+            try:
+                info.linkname = os.readlink(path)
+            except OSError:
+                return None
+        elif stat.S_ISFIFO(st.st_mode):
+            info.type = tarfile.FIFOTYPE
+        elif stat.S_ISCHR(st.st_mode) or stat.S_ISBLK(st.st_mode):
+            info.type = tarfile.CHRTYPE if stat.S_ISCHR(st.st_mode) else tarfile.BLKTYPE
+            info.devmajor = os.major(st.st_rdev)
+            info.devminor = os.minor(st.st_rdev)
+        else:
+            return None
+        return info
+
+    users = {}
+    groups = {}
+
+    @staticmethod
+    def uname(uid):
+        if not TarArchive.users.has_key(uid):
+            try:
+                TarArchive.users[uid] = pwd.getpwuid(uid)[0]
+            except KeyError:
+                TarArchive.users[uid] = ''
+        return TarArchive.users[uid]
+
+    @staticmethod
+    def gname(gid):
+        if not TarArchive.groups.has_key(gid):
+            try:
+                TarArchive.groups[gid] = grp.getgrgid(gid)[0]
+            except KeyError:
+                TarArchive.groups[gid] = ''
+        return TarArchive.groups[gid]
+
+#
+#
+#
+class PaddedFile:
+    """Read exactly 'size' bytes of a file, padded with zeros if the file has shrunk (or cannot be read)
+    """
+
+    def __init__(self, f, size):
+        self.f = f
+        self.size = size
+        self.error = None
+
+    def read(self, size):
+        size = min(size, self.size)
+        data = ''
+        if self.error == None:
+            try:
+                data = self.f.read(size)
+            except (OSError, IOError) as err:
+                self.error = err
+        if len(data) < size:
+            data += '\0' * (size - len(data))
+        self.size -= len(data)
+        return data
+
+#
+#
+#
+class ZipArchive:
+    """Zip archive of a folder
+
+    Unlike a tar.gz stream, each member of a zip archive has its own compression.
+    The files which are already compressed (media, archives...) are stored as-is:
+    they are detected by their extension ('store_extensions') or by compressing a sample of their content.
+    """
+
+    SAMPLE_SIZE = 64 * 1024
+
+    @staticmethod
+    def write(settings, section, folder, rules, writer):
+        """Write the zip archive of a folder into the output writer
+        """
+        extensions = STORE_EXTENSIONS
+        if settings.has_option(section, 'store_extensions'):
+            extensions = [x.strip(' .').lower() for x in settings.get(section, 'store_extensions').split(',')]
+        probe = not settings.has_option(section, 'compress_probe') or settings.get(section, 'compress_probe').lower().strip() == 'true'
+
+        # A zip archive is written with seeks, so it cannot be streamed in volumes
+        tmp_file = writer.name + '.tmp'
+        archive = zipfile.ZipFile(tmp_file, 'w', zipfile.ZIP_DEFLATED, True)
+        for path, st in rules.walk(folder):
+            arcname = path.lstrip('/')
+            try:
+                if stat.S_ISDIR(st.st_mode):
+                    archive.write(path, arcname)
+                elif stat.S_ISLNK(st.st_mode):
+                    info = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[:6])
+                    info.external_attr = (st.st_mode & 0xFFFF) << 16
+                    archive.writestr(info, os.readlink(path))
+                elif stat.S_ISREG(st.st_mode):
+                    if ZipArchive.compressible(path, st, extensions, probe):
+                        archive.write(path, arcname, zipfile.ZIP_DEFLATED)
+                    else:
+                        archive.write(path, arcname, zipfile.ZIP_STORED)
+            except (OSError, IOError):
+                print "Cannot read file " + path
+        archive.close()
+
+        writer.adopt(tmp_file)
+
+    @staticmethod
+    def compressible(path, st, extensions, probe=True):
+        """Decide if a file is worth compressing
+        """
+        ext = os.path.splitext(path)[1].lstrip('.').lower()
+        if ext in extensions:
+            return False
+        if not probe or st.st_size < 4096:
+            return True
+
+        # Fast compression of a sample
+        try:
+            f = open(path, 'rb')
+            sample = f.read(ZipArchive.SAMPLE_SIZE)
+            f.close()
+        except (OSError, IOError):
+            return True
+        return len(zlib.compress(sample, 1)) < 0.9 * len(sample)
+
+#
+#
+#
+class Snapshot:
+    """Snapshot of a folder
+
+    Instead of an archive, a dated copy of the folder is written into the archive folder ('name_DATE.snapshot').
+    The files which did not change since the previous snapshot (same size, date, mode and owner) are hard links to it,
+    so only the changed files are copied and each snapshot can be browsed as a full copy.
+    The owners are kept when distbackup runs as root (otherwise they are not compared).
+    """
 
-        ret = "%-10s %8s %8s %8s %8s" % ( "Disk", "Size", "Used", "Avail", "Use%" )
-        for disk in disks:
+    @staticmethod
+    def process(settings, section, folder, rules):
+        archive_folder = settings.get('default', 'archive')
+        if settings.has_option(section, 'group'):
+            archive_folder = os.path.join(archive_folder, settings.get(section, 'group'))
+        name = settings.get(section, 'output')
+        date = datetime.datetime.now().strftime("%Y-%m-%d")
+        dest = os.path.join(archive_folder, name + '_' + date + '.snapshot')
+        previous = Snapshot.previous(archive_folder, name, dest)
+
+        if debug:
+            print DBG_MSG + "* Snapshot folder " + folder + " -> " + dest + DBG_MSG_END
+            if previous != None:
+                print DBG_MSG + "  (link: " + previous + ")" + DBG_MSG_END
+            return {'folder': dest}
+
+        before = datetime.datetime.now()
+
+        # The snapshot is written in a temporary folder, then renamed
+        tmp = dest + '.tmp'
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+
+        root = folder.rstrip('/') or '/'
+        owners = os.geteuid() == 0
+        linked = 0
+        copied = 0
+        folders = []
+        for path, st in rules.walk(folder):
+            rel = os.path.relpath(path, root)
+            target = os.path.normpath(os.path.join(tmp, rel))
             try:
-                status = os.statvfs(disk.strip(' '))
+                if stat.S_ISDIR(st.st_mode):
+                    os.makedirs(target)
+                    Snapshot.chown(target, st, owners)
+                    folders.append((path, target))
+                elif stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(path), target)
+                    Snapshot.chown(target, st, owners)
+                elif stat.S_ISREG(st.st_mode):
+                    if previous != None and Snapshot.unchanged(st, os.path.join(previous, rel), owners):
+                        os.link(os.path.join(previous, rel), target)
+                        linked += 1
+                    else:
+                        # The owner is changed before the mode, as chown can clear the setuid bits
+                        shutil.copyfile(path, target)
+                        Snapshot.chown(target, st, owners)
+                        shutil.copystat(path, target)
+                        copied += 1
             except (OSError, IOError):
-                print disk
-                status = False
+                print "Cannot copy file " + path
 
-            if status == False or status.f_blocks == 0:
-                continue
+        # Folder dates, once their content is written
+        for path, target in reversed(folders[1:]):
+            try:
+                shutil.copystat(path, target)
+            except OSError:
+                pass
+
+        if os.path.exists(dest):
+            shutil.rmtree(dest)
+        os.rename(tmp, dest)
+
+        stats = {
+            'files': rules.files,
+            'bytes': rules.bytes,
+            'seconds': (datetime.datetime.now() - before).total_seconds(),
+            'linked': linked,
+            'copied': copied
+        }
+        return {
+            'folder': dest,
+            'stats': stats
+        }
 
-            free = status.f_bfree * status.f_frsize
-            size = status.f_blocks * status.f_frsize
-            avail = status.f_bavail * status.f_frsize
-            used = (status.f_blocks - status.f_bfree) * status.f_frsize
-            used_percent = str( round(100. * used / size, 1) ) + '%'
+    @staticmethod
+    def previous(folder, name, dest):
+        """Latest snapshot before the current one
+        """
+        snapshots = [x for x in glob.glob(os.path.join(folder, name + '_*.snapshot')) if x != dest and DATE_REG.search(os.path.basename(x))]
+        if len(snapshots) == 0:
+            return None
+        return max(snapshots)
 
-            ret += "\n%-10s %8s %8s %8s %8s" % ( disk, sizeof_fmt(size, ''), sizeof_fmt(used, ''), sizeof_fmt(avail, ''), used_percent )
-        return ret
+    @staticmethod
+    def chown(target, st, owners):
+        if owners:
+            os.lchown(target, st.st_uid, st.st_gid)
+
+    @staticmethod
+    def unchanged(st, path, owners):
+        try:
+            prev = os.lstat(path)
+        except OSError:
+            return False
+        if owners and (prev.st_uid != st.st_uid or prev.st_gid != st.st_gid):
+            return False
+        return stat.S_ISREG(prev.st_mode) and prev.st_size == st.st_size and int(prev.st_mtime) == int(st.st_mtime) \
+            and prev.st_mode == st.st_mode
 
 #
 #
@@ -509,18 +2429,21 @@ def dirBackup(settings, section):
         return False
     folder = settings.get(section, 'folder')
     if not os.path.exists(folder):
-        return False
+        raise BackupError("Folder not found: " + folder)
 
-    # Manage exclude list
-    excludes = []
-    if settings.has_option(section, 'exclude'):
-        excludes = [x.strip(' ') for x in settings.get(section, 'exclude').split(',')]
-    if len(excludes) == 0 and settings.has_option('default', 'exclude'):
-        excludes = [x.strip(' ') for x in settings.get('default', 'exclude').split(',')]
+    # Manage exclusion rules
+    rules = ExcludeRules(settings, section)
 
     # Set archive format (improvement needed)
     archive_format = 'tar.gz'
     archive_format_parameter = '--gzip' # --bzip2
+    if settings.has_option(section, 'format') and settings.get(section, 'format').lower().strip() == 'zip':
+        archive_format = 'zip'
+    if settings.has_option(section, 'format') and settings.get(section, 'format').lower().strip() == 'snapshot':
+        return Snapshot.process(settings, section, folder, rules)
+    engine = 'tar'
+    if settings.has_option(section, 'engine'):
+        engine = settings.get(section, 'engine').lower().strip()
 
     # Set the output files/folder
     output_folder = settings.get('default', 'output')
@@ -528,41 +2451,100 @@ def dirBackup(settings, section):
     output_file = os.path.join(output_folder, output_filename)
 
     # Processing params
-    params = ['tar'] + [ ('--exclude="' + x + '"') for x in excludes ] + [
+    # The list of files is given by the exclusion rules walk
+    params = [
+        'tar',
         '--ignore-failed-read',
         archive_format_parameter,
         '-cf',
-        output_file,
+        '-',
         '-C',
         '/',
-        folder.lstrip('/')
+        '--no-recursion',
+        '--null',
+        '-T',
+        '-'
     ]
 
+    # With the adaptive compression, tar gives an uncompressed stream
+    adaptive = adaptiveCompression(settings, section)
+    if adaptive:
+        params.remove(archive_format_parameter)
+
     if debug:
         print DBG_MSG + "* Backup folder " + folder + " -> " + output_file + DBG_MSG_END
-        if len(excludes) > 0:
-            print DBG_MSG + "  (exclude: " + ", ".join(excludes) + ")" + DBG_MSG_END
+        if len(rules.patterns) > 0:
+            print DBG_MSG + "  (exclude: " + ", ".join(rules.patterns) + ")" + DBG_MSG_END
+        if settings.has_option(section, 'split_size'):
+            print DBG_MSG + "  (split: " + settings.get(section, 'split_size') + " volumes)" + DBG_MSG_END
+        if adaptive and archive_format != 'zip':
+            print DBG_MSG + "  (compression: adaptive)" + DBG_MSG_END
         return {'file': output_file}
 
     before_tar = datetime.datetime.now()
 
     os.chdir('/')
-    ret = subprocess.call(params)
+    writer = openOutput(settings, section, output_file)
+    gz = None
+    tar_code = 0
+    if archive_format == 'zip':
+        ZipArchive.write(settings, section, folder, rules, writer)
+    elif engine == 'python':
+        gz = openCompressor(settings, section, writer, 6)
+        TarArchive.write(settings, section, folder, rules, gz)
+    else:
+        tar = subprocess.Popen(params, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        # With 'read_threads', the files are given to tar in the read-ahead order,
+        # so tar finds their content in the page cache
+        entries = rules.walk(folder)
+        if settings.has_option(section, 'read_threads'):
+            entries = ReadAhead(entries, int(settings.get(section, 'read_threads').strip()), keep=False)
+
+        def feed():
+            for entry in entries:
+                tar.stdin.write(entry[0].lstrip('/') + '\0')
+            tar.stdin.close()
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+
+        if adaptive:
+            gz = openCompressor(settings, section, writer, 6)
+            shutil.copyfileobj(tar.stdout, gz, 2**20)
+            gz.close()
+        else:
+            writer.copy(tar.stdout)
+        feeder.join()
+        tar_code = tar.wait()
+    writer.close()
+
+    # tar exits with 1 when files changed during the archive
+    checkExit('tar', tar_code, 1)
 
     # We can have the backup duration
     after_tar = datetime.datetime.now()
+    stats = {
+        'files': rules.files,
+        'bytes': rules.bytes,
+        'seconds': (after_tar - before_tar).total_seconds()
+    }
+    compression = None
+    if isinstance(gz, AdaptiveGzip):
+        compression = gz.result()
 
     # Return if we do not have to create the info file
     if (not settings.has_option(section, 'info') or (settings.get(section, 'info').lower().strip() != 'true')):
-        return {
-            'file': output_file
-        }
+        ret = writer.result()
+        ret['stats'] = stats
+        if compression != None:
+            ret['compression'] = compression
+        return ret
 
     # Generation of the info file
     info_file = output_file.replace('.'+archive_format, '.info.txt')
     uname = os.uname()
     hostname = uname[0] + '@' + uname[1]
-    md5_hash = generate_file_md5(output_folder, output_file)
+    md5_hash = writer.md5()
 
     file_content = '''
 Directory backup :
@@ -570,7 +2552,10 @@ Directory backup :
  User : ''' + hostname + '''
  Folder : ''' + folder + '''
  MD5 : ''' + md5_hash + '''
+ Files : ''' + str(stats['files']) + ' (' + sizeof_fmt(stats['bytes']) + ', ' + throughput(stats) + ''')
 '''
+    if compression != None:
+        file_content += ' Compression : gzip levels ' + compressionLevels(compression) + '\n'
 
     f = open(info_file, 'w')
     f.write(file_content)
@@ -588,15 +2573,20 @@ Directory backup :
     fi
     '''
 
-    return {
-        'files': [output_file, info_file]
+    ret = writer.result()
+    ret = {
+        'files': writer.files() + [info_file],
+        'md5': ret['md5'],
+        'stats': stats
     }
+    if compression != None:
+        ret['compression'] = compression
+    return ret
 
 #
 #
 #
 def generate_file_md5(rootdir, filename, blocksize=2**20):
-    import hashlib
     m = hashlib.md5()
     try:
         with open( os.path.join(rootdir, filename) , "rb" ) as f:
@@ -609,6 +2599,235 @@ def generate_file_md5(rootdir, filename, blocksize=2**20):
         return '-- Hash Error --'
     return m.hexdigest()
 
+#
+#
+#
+class VolumeWriter:
+    """Output file writer
+
+    Write the output of a backup in a single file or, if a split size is given,
+    in numbered volumes ('.001', '.002'...) with a '.md5' manifest (md5sum format)
+    giving the hash of each volume.
+    """
+
+    def __init__(self, output_file, split_size=0):
+        self.name = output_file
+        self.mode = 'wb'
+        self.split_size = split_size
+        self.volumes = []
+        self.hashes = []
+        self.hash = hashlib.md5()
+        self.size = 0
+        self.current = None
+
+        # Remove the outputs of a previous run which would not be overwritten
+        stale = glob.glob(output_file + '.[0-9][0-9][0-9]') + glob.glob(output_file + '.md5')
+        if split_size > 0 and os.path.isfile(output_file):
+            stale.append(output_file)
+        for f in stale:
+            os.remove(f)
+
+        self.next()
+
+    def next(self):
+        """Close the current volume and open the next one
+        """
+        if self.current != None:
+            self.current.close()
+            self.hashes.append(self.current_hash.hexdigest())
+        if self.split_size > 0:
+            filename = self.name + ('.%03d' % (len(self.volumes) + 1))
+        else:
+            filename = self.name
+        self.volumes.append(filename)
+        self.current = open(filename, 'wb')
+        self.current_hash = hashlib.md5()
+        self.current_size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        while len(data) > 0:
+            if self.split_size > 0 and self.current_size >= self.split_size:
+                self.next()
+            chunk = data
+            if self.split_size > 0:
+                chunk = data[:self.split_size - self.current_size]
+            self.current.write(chunk)
+            self.current_hash.update(chunk)
+            self.current_size += len(chunk)
+            data = data[len(chunk):]
+
+    def copy(self, source, blocksize=2**20):
+        """Write the whole content of a stream
+        """
+        while True:
+            buf = source.read(blocksize)
+            if not buf:
+                break
+            self.write(buf)
+
+    def adopt(self, path):
+        """Use a file written by another tool as output
+
+        The file is moved to the output file, or split in volumes.
+        """
+        if self.split_size > 0:
+            f = open(path, 'rb')
+            self.copy(f)
+            f.close()
+            os.remove(path)
+            return
+
+        self.current.close()
+        os.rename(path, self.name)
+        self.current = open(self.name, 'ab')
+        f = open(self.name, 'rb')
+        while True:
+            buf = f.read(2**20)
+            if not buf:
+                break
+            self.hash.update(buf)
+            self.current_hash.update(buf)
+            self.size += len(buf)
+            self.current_size += len(buf)
+        f.close()
+
+    def flush(self):
+        self.current.flush()
+
+    def close(self):
+        if self.current == None:
+            return
+        self.current.close()
+        self.hashes.append(self.current_hash.hexdigest())
+        self.current = None
+
+        if self.split_size > 0:
+            f = open(self.name + '.md5', 'w')
+            for volume, md5_hash in zip(self.volumes, self.hashes):
+                f.write(md5_hash + '  ' + os.path.basename(volume) + '\n')
+            f.close()
+
+    def md5(self):
+        """MD5 hash of the whole output
+        """
+        return self.hash.hexdigest()
+
+    def files(self):
+        """List of the written files
+        """
+        if self.split_size > 0:
+            return self.volumes + [self.name + '.md5']
+        return self.volumes
+
+    def result(self):
+        """Backup return value
+        """
+        if self.split_size > 0:
+            return {'files': self.files(), 'md5': dict(zip(self.volumes, self.hashes))}
+        return {'file': self.name, 'md5': {self.name: self.md5()}}
+
+#
+#
+#
+def openOutput(settings, section, output_file):
+    """Open the output file of a section
+
+    The output is split in volumes when the section has a 'split_size'
+    """
+    split_size = 0
+    if settings.has_option(section, 'split_size'):
+        split_size = parse_size(settings.get(section, 'split_size'))
+    return VolumeWriter(output_file, split_size)
+
+#
+#
+#
+def adaptiveCompression(settings, section):
+    return settings.has_option(section, 'compression') and settings.get(section, 'compression').lower().strip() == 'adaptive'
+
+#
+#
+#
+def openCompressor(settings, section, writer, level=9):
+    """Open the gzip compression of the output of a section
+
+    With 'compression=adaptive', the level is chosen from the time left before the deadline (see AdaptiveGzip)
+    """
+    if not adaptiveCompression(settings, section):
+        return gzip.GzipFile(os.path.basename(writer.name), 'wb', level, writer)
+    if schedule == None:
+        return AdaptiveGzip(writer, level=level)
+    return AdaptiveGzip(writer, schedule.budget(section), schedule.expected(section), level)
+
+#
+#
+#
+def writeOutput(settings, section, output_file, source, compress=True):
+    """Write a stream as the (gzip) output of a section
+    """
+    writer = openOutput(settings, section, output_file)
+    if compress:
+        f = openCompressor(settings, section, writer)
+    else:
+        f = writer
+    while True:
+        buf = source.read(2**20)
+        if not buf:
+            break
+        f.write(buf)
+    f.close()
+    writer.close()
+    ret = writer.result()
+    if isinstance(f, AdaptiveGzip):
+        ret['compression'] = f.result()
+    return ret
+
+#
+#
+#
+def checkExit(command, code, limit=0):
+    """Fail the section when a command ends with an error code (above 'limit', or killed)
+    """
+    if code < 0 or code > limit:
+        raise BackupError(command + " failed (exit code " + str(code) + ")")
+
+#
+#
+#
+def parallel_map(function, items, workers=1):
+    """Call a function on each item, with a pool of threads
+    """
+    if workers <= 1 or len(items) <= 1:
+        return [function(x) for x in items]
+
+    results = [None] * len(items)
+    errors = []
+    queue = Queue.Queue()
+    for i, item in enumerate(items):
+        queue.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                i, item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = function(item)
+            except Exception as err:
+                errors.append(err)
+
+    threads = [threading.Thread(target=worker) for x in range(min(workers, len(items)))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if len(errors) > 0:
+        raise errors[0]
+    return results
+
 #
 #
 #
@@ -628,59 +2847,292 @@ def cleanBackup(settings, section):
 
     base_date = datetime.datetime.today() - datetime.timedelta(days=clean_days)
     now = datetime.datetime.now()
-    reg = re.compile(r'_(\d{4})-(\d{2})-(\d{2})\.', re.UNICODE)
+    reg = DATE_REG
 
     archive_folder = settings.get('default', 'archive')
 
     if settings.has_option(section, 'group'):
         archive_folder = os.path.join(archive_folder, settings.get(section, 'group'))
 
+    # Regroup the files by backup (the volumes of a backup are cleaned together)
+    backups = {}
     for dirpath, dirs, files in os.walk(archive_folder):
+        # A snapshot folder is a single backup
+        for name in [x for x in dirs if x.endswith('.snapshot') or x.endswith('.snapshot.tmp')]:
+            dirs.remove(name)
+            if name.endswith('.snapshot'):
+                backups[os.path.join(dirpath, name)] = [os.path.join(dirpath, name)]
         for name in dirs + files:
             fullname = os.path.join(dirpath, name)
             if not os.path.isfile(fullname):
                 continue
+            key = VOLUME_REG.sub('', fullname)
+            if not backups.has_key(key):
+                backups[key] = []
+            backups[key].append(fullname)
+
+    expired = {}
+    for key in sorted(backups):
+        name = os.path.basename(key)
+        fullname = key
+
+        mtime = 0
+        days = 0
+        try:
+            mtime = max([datetime.datetime.fromtimestamp(os.path.getmtime(f)) for f in backups[key]])
+            seconds = now - mtime
+            days, seconds = divmod(abs(int(seconds.total_seconds())), 86400)
+        except:
+            if debug:
+                print DBG_MSG + "* Error with file " + fullname + DBG_MSG_END
+            else:
+                print "Cannot access file " + fullname
 
-            mtime = 0
-            days = 0
-            try:
-                mtime = datetime.datetime.fromtimestamp(os.path.getmtime(fullname))
-                seconds = now - mtime
-                days, seconds = divmod(abs(int(seconds.total_seconds())), 86400)
-            except:
-                if debug:
-                    print DBG_MSG + "* Error with file " + fullname + DBG_MSG_END
-                else:
-                    print "Cannot access file " + fullname
+        # If the file is too recent or we couldn't get his "mtime"
+        if mtime == 0 or mtime >= base_date:
+            continue
 
-            # If the file is too recent or we couldn't get his "mtime"
-            if mtime == 0 or mtime >= base_date:
-                continue
+        # Test the file name to match the format criteria
+        match = reg.search(name)
+        if match == None:
+            continue
 
-            # Test the file name to match the format criteria
-            match = reg.search(name)
-            if match == None:
-                continue
+        # Keep files on first day of each month
+        if keep_first_days < 0 and int(match.group(3)) == 1:
+            continue
 
-            # Keep files on first day of each month
-            if keep_first_days < 0 and int(match.group(3)) == 1:
-                continue
+        # Limit the number of files for the first day of each month
+        if keep_first_days > 0 and int(match.group(3)) == 1 and keep_first_days > days:
+            continue
 
-            # Limit the number of files for the first day of each month
-            if keep_first_days > 0 and int(match.group(3)) == 1 and keep_first_days > days:
-                continue
+        expired[key] = days
 
+    # Keep the archives needed by a delta which is kept
+    chains = {}
+    for key in backups:
+        match = reg.search(os.path.basename(key))
+        if match == None:
+            continue
+        ext = os.path.basename(key)[match.end() - 1:]
+        if ext in ['.gz', '.xd3']:
+            chain = (os.path.dirname(key), os.path.basename(key)[:match.start()])
+            if not chains.has_key(chain):
+                chains[chain] = []
+            chains[chain].append(('-'.join(match.groups()), key, ext == '.gz'))
+    for chain in chains.values():
+        needed = False
+        for date, key, is_full in sorted(chain, reverse=True):
+            if needed and expired.has_key(key):
+                del expired[key]
+            if is_full:
+                needed = False
+            elif not expired.has_key(key):
+                needed = True
+
+    catalog = None
+    if not debug and len(expired) > 0:
+        catalog = Catalog.existing(settings)
+
+    for key in sorted(expired):
+        days = expired[key]
+        if catalog != None:
+            catalog.remove(key)
+        for fullname in sorted(backups[key]):
             if debug:
                 print DBG_MSG + ("* Clean file %s (%d days) " % (fullname, days)) + DBG_MSG_END
             else:
                 # Delete the file
                 try:
-                    os.remove(fullname)
+                    if os.path.isdir(fullname):
+                        shutil.rmtree(fullname)
+                    else:
+                        os.remove(fullname)
                 except:
                     print "Cannot delete file " + fullname
 
+    if catalog != None:
+        catalog.close()
+
+    # Remove the database log files whose full dump has been removed
+    for dirpath, dirs, files in os.walk(archive_folder):
+        if 'segments.index' in files:
+            cleanLogs(dirpath)
+
+    return False
+
+#
+#
+#
+def cleanLogs(folder):
+    """Clean the archived database logs (binlog action) linked to a removed full dump
+    """
+    index_file = os.path.join(folder, 'segments.index')
+    f = open(index_file, 'r')
+    lines = f.readlines()
+    f.close()
+
+    kept = []
+    for line in lines:
+        (segment, base) = line.rstrip('\n').split('\t')[:2]
+        # The dump may have been recompressed with another extension
+        if base == '-' or os.path.exists(base) or len([x for x in glob.glob(splitext(base)[0] + '.*') if not x.endswith('.position')]) > 0:
+            kept.append(line)
+            continue
+        fullname = os.path.join(folder, segment)
+        if debug:
+            print DBG_MSG + "* Clean file " + fullname + DBG_MSG_END
+            kept.append(line)
+        elif os.path.exists(fullname):
+            os.remove(fullname)
+
+    if len(kept) != len(lines):
+        f = open(index_file + '.tmp', 'w')
+        f.writelines(kept)
+        f.close()
+        os.rename(index_file + '.tmp', index_file)
+
+#
+#
+#
+def recompactBackup(settings, section):
+    """Recompact Backup
+
+    Recompress the old gzip archives with a denser codec (xz, zstd, bzip2).
+    The result is verified before replacing the original archive, which keeps its date.
+    """
+    codecs = {
+        'xz': ('.xz', ['xz', '-c', '-T1'], ['xz', '-dc']),
+        'zstd': ('.zst', ['zstd', '-c', '-q'], ['zstd', '-dcq']),
+        'bzip2': ('.bz2', ['bzip2', '-c'], ['bzip2', '-dc'])
+    }
+
+    codec = 'xz'
+    if settings.has_option(section, 'codec'):
+        codec = settings.get(section, 'codec').lower().strip()
+    if not codecs.has_key(codec):
+        return False
+    (codec_ext, codec_params, check_params) = codecs[codec]
+    level = {'xz': '9', 'zstd': '19', 'bzip2': '9'}[codec]
+    if settings.has_option(section, 'level'):
+        level = settings.get(section, 'level').strip()
+    codec_params = codec_params + ['-' + level]
+
+    recompact_days = 30
+    if settings.has_option(section, 'days'):
+        recompact_days = int(settings.get(section, 'days').strip())
+
+    # CPU and I/O budget
+    max_duration = 0
+    if settings.has_option(section, 'max_duration'):
+        max_duration = int(settings.get(section, 'max_duration').strip()) * 60
+    priority = []
+    if not settings.has_option(section, 'nice') or settings.get(section, 'nice').lower().strip() == 'true':
+        priority = ['nice', '-n', '19']
+        if distutils.spawn.find_executable('ionice'):
+            priority = ['ionice', '-c', '3'] + priority
+
+    archive_folder = settings.get('default', 'archive')
+    if settings.has_option(section, 'group'):
+        archive_folder = os.path.join(archive_folder, settings.get(section, 'group'))
+
+    # Find the old gzip archives (not the volumes, nor the bases of database deltas)
+    base_date = time.time() - recompact_days * 86400
+    candidates = []
+    for dirpath, dirs, files in os.walk(archive_folder):
+        for name in [x for x in dirs if x == '.delta' or x.endswith('.snapshot') or x.endswith('.snapshot.tmp')]:
+            dirs.remove(name)
+        for name in sorted(files):
+            fullname = os.path.join(dirpath, name)
+            match = DATE_REG.search(name)
+            if match == None or VOLUME_REG.search(name) != None:
+                continue
+            ext = name[match.end() - 1:]
+            if not ext in ['.tar.gz', '.gz']:
+                continue
+            if ext == '.gz' and len([x for x in DeltaArchive.chain(dirpath, name[:match.start()]) if not x[2]]) > 0:
+                continue
+            if os.path.getmtime(fullname) >= base_date:
+                continue
+            candidates.append(fullname)
+
+    if debug:
+        for f in candidates:
+            print DBG_MSG + "* Recompact " + f + " -> " + f[:-len('.gz')] + codec_ext + DBG_MSG_END
+        return False
+
+    # The recompaction can run in the background, without delaying the next sections
+    if settings.has_option(section, 'background') and settings.get(section, 'background').lower().strip() == 'true':
+        if os.fork() != 0:
+            return False
+        try:
+            recompactFiles(candidates, codec_ext, codec_params, check_params, max_duration, Catalog.existing(settings), priority)
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(0)
+
+    recompactFiles(candidates, codec_ext, codec_params, check_params, max_duration, Catalog.existing(settings), priority)
     return False
 
+#
+#
+#
+def recompactFiles(files, codec_ext, codec_params, check_params, max_duration=0, catalog=None, priority=[]):
+    """Recompress gzip files with another codec
+
+    The priority prefix (nice, ionice) applies to the decompression, the compression and the verification.
+    """
+    start = time.time()
+    for f in files:
+        if max_duration > 0 and time.time() - start > max_duration:
+            break
+
+        dest = f[:-len('.gz')] + codec_ext
+        tmp = dest + '.tmp'
+
+        # Recompress, with the hash of the uncompressed data
+        source_hash = hashlib.md5()
+        gz = subprocess.Popen(priority + ['gzip', '-dc', f], stdout=subprocess.PIPE)
+        out = open(tmp, 'wb')
+        comp = subprocess.Popen(priority + codec_params, stdin=subprocess.PIPE, stdout=out)
+        while True:
+            buf = gz.stdout.read(2**20)
+            if not buf:
+                break
+            source_hash.update(buf)
+            comp.stdin.write(buf)
+        comp.stdin.close()
+        err = gz.wait() + comp.wait()
+        out.close()
+
+        # Verify the new file
+        dest_hash = hashlib.md5()
+        if err == 0:
+            check = subprocess.Popen(priority + check_params + [tmp], stdout=subprocess.PIPE)
+            while True:
+                buf = check.stdout.read(2**20)
+                if not buf:
+                    break
+                dest_hash.update(buf)
+            err = check.wait()
+
+        if err != 0 or source_hash.hexdigest() != dest_hash.hexdigest():
+            print "Cannot recompact file " + f
+            os.remove(tmp)
+            continue
+
+        # Replace the file, keeping its date (used by the clean action)
+        st = os.stat(f)
+        os.chmod(tmp, stat.S_IMODE(st.st_mode))
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, dest)
+        os.remove(f)
+        if catalog != None:
+            catalog.rename(f, dest)
+
+    if catalog != None:
+        catalog.close()
+
 #
 #
 #
@@ -709,6 +3161,176 @@ def dpkgBackup(settings, section):
 
     return True
 
+#
+#
+#
+class Journal:
+    """Run journal
+
+    The state of each section of the run is recorded in the output folder ('distbackup.journal'),
+    with the output files, their size, date and hash.
+    When the run is resumed ('--resume'), the sections already done with intact outputs are skipped.
+    A run without failed section is marked finished: resuming it starts a new run.
+    The previous run also gives the expected duration and input size of each section.
+    """
+
+    def __init__(self, settings, configFile, resume=False):
+        self.filename = None
+        if settings.has_option('default', 'output'):
+            self.filename = os.path.join(settings.get('default', 'output'), 'distbackup.journal')
+        self.config = os.path.abspath(configFile)
+        self.sections = {}
+        self.previous = {}
+        self.finished = False
+
+        if self.filename != None and os.path.isfile(self.filename):
+            try:
+                f = open(self.filename, 'r')
+                data = json.load(f)
+                f.close()
+                if data.get('config') == self.config:
+                    self.previous = data['sections']
+                    self.finished = data.get('finished', False)
+            except (OSError, IOError, ValueError):
+                print "Cannot read the journal " + self.filename
+        if resume and not self.finished:
+            self.sections = dict(self.previous)
+        self.finished = False
+        self.save()
+
+    def save(self):
+        """Write the journal (atomically)
+        """
+        if debug or self.filename == None:
+            return
+        tmp = self.filename + '.tmp'
+        f = open(tmp, 'w')
+        json.dump({'config': self.config, 'finished': self.finished, 'sections': self.sections}, f, indent=1)
+        f.flush()
+        os.fsync(f.fileno())
+        f.close()
+        os.rename(tmp, self.filename)
+
+    def start(self, section):
+        self.sections[section] = {'status': 'running', 'start': time.time()}
+        self.save()
+
+    def failed(self, section):
+        self.sections[section]['status'] = 'failed'
+        self.save()
+
+    def finish(self):
+        """Mark the run as complete
+        """
+        self.finished = True
+        self.save()
+
+    def done(self, section, data):
+        """Record a finished section and its outputs
+        """
+        outputs = {}
+        ret = data['ret']
+        if isinstance(ret, dict) and (ret.has_key('file') or ret.has_key('files')):
+            files = ret['file'] if ret.has_key('file') else ret['files']
+            if isinstance(files, basestring):
+                files = [files]
+            hashes = ret.get('md5', {})
+            for f in files:
+                if not os.path.isfile(f):
+                    continue
+                outputs[f] = {
+                    'size': os.path.getsize(f),
+                    'mtime': os.path.getmtime(f),
+                    'md5': hashes[f] if hashes.has_key(f) else generate_file_md5('', f)
+                }
+
+        self.sections[section] = {
+            'status': 'done',
+            'start': time.mktime(data['start'].timetuple()),
+            'end': time.mktime(data['end'].timetuple()),
+            'ret': ret,
+            'outputs': outputs
+        }
+        self.save()
+
+    def completed(self, section):
+        """Return the result of a section already done, or None if it has to be processed
+
+        The outputs must still have the same size and date.
+        """
+        entry = self.sections.get(section)
+        if entry == None or entry['status'] != 'done':
+            return None
+        for f, info in entry['outputs'].items():
+            if not os.path.isfile(f) or os.path.getsize(f) != info['size'] or os.path.getmtime(f) != info['mtime']:
+                return None
+
+        # JSON strings are unicode
+        ret = entry['ret']
+        if isinstance(ret, dict):
+            ret = dict([(str(k), v) for k, v in ret.items()])
+            if ret.has_key('file'):
+                ret['file'] = str(ret['file'])
+            if ret.has_key('files'):
+                ret['files'] = [str(x) for x in ret['files']]
+        return {
+            'start': datetime.datetime.fromtimestamp(entry['start']),
+            'end': datetime.datetime.fromtimestamp(entry['end']),
+            'section': section,
+            'ret': ret
+        }
+
+    def duration(self, section):
+        """Duration of a section in the previous run (seconds)
+        """
+        entry = self.previous.get(section)
+        if entry == None or entry['status'] != 'done':
+            return 0
+        return entry['end'] - entry['start']
+
+    def inputSize(self, section):
+        """Uncompressed size of the output of a section in the previous run (bytes)
+        """
+        entry = self.previous.get(section)
+        if entry == None or entry['status'] != 'done' or not isinstance(entry['ret'], dict):
+            return 0
+        if entry['ret'].has_key('compression'):
+            return entry['ret']['compression']['input']
+        if entry['ret'].has_key('stats'):
+            return entry['ret']['stats']['bytes']
+        return 0
+
+#
+#
+#
+class Schedule:
+    """Backup window
+
+    The run has to end before the 'deadline' (HH:MM) of the default section.
+    The time budget of a section is the time left before the deadline,
+    minus the duration of the next sections in the previous run (journal).
+    """
+
+    def __init__(self, settings, journal):
+        hour, minute = [int(x) for x in settings.get('default', 'deadline').strip().split(':')]
+        now = datetime.datetime.now()
+        self.end = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+        if self.end <= now:
+            self.end += datetime.timedelta(days=1)
+        self.sections = [x for x in settings.sections() if x != 'default']
+        self.journal = journal
+
+    def budget(self, section):
+        """Time budget of a section (seconds)
+        """
+        following = self.sections[self.sections.index(section) + 1:]
+        reserved = sum([self.journal.duration(x) for x in following])
+        left = (self.end - datetime.datetime.now()).total_seconds()
+        return max(left - reserved, 0)
+
+    def expected(self, section):
+        return self.journal.inputSize(section)
+
 #
 #
 #
@@ -727,12 +3349,16 @@ def processBackup(settings, section, result=None):
         return SyncBackup.process(settings, section, result)
     elif t == 'db' or t == 'database':
         return DatabaseBackup.process(settings, section)
+    elif t == 'binlog':
+        return LogBackup.process(settings, section)
     elif t == 'svn':
         return SvnBackup.process(settings, section)
     elif t == 'report':
         return ReportBackup.process(settings, section)
     elif t == 'clean':
         return cleanBackup(settings, section)
+    elif t == 'recompact':
+        return recompactBackup(settings, section)
     elif t == 'dpkg':
         return dpkgBackup(settings, section)
     return 0
@@ -795,14 +3421,51 @@ def pretty_timedelta(data):
         return '%dm%ds' % (minutes, seconds)
     return '%ds' % (seconds,)
 
+#
+#
+#
+def throughput(stats):
+    """Display function: files and bytes per second
+    """
+    seconds = max(stats['seconds'], 0.001)
+    return "%d files/s, %s" % (stats['files'] / seconds, sizeof_fmt(stats['bytes'] / seconds, 'B/s'))
+
+#
+#
+#
+def compressionLevels(compression):
+    """Text of the compression levels used (and their uncompressed size)
+    """
+    levels = sorted(compression['levels'].items(), key=lambda x: -int(x[0]))
+    return ", ".join([str(level) + ": " + sizeof_fmt(size) for level, size in levels])
+
 #
 #
 #
 def splitext(path):
-    for ext in ['.tar.gz', '.tar.bz2']:
+    # Volume suffix ('.001') or volume manifest ('.md5')
+    volume = ''
+    match = VOLUME_REG.search(path)
+    if match != None:
+        volume = match.group(0)
+        path = path[:-len(volume)]
+    for ext in ['.tar.gz', '.tar.bz2', '.tar.xz', '.tar.zst']:
         if path.endswith(ext):
-            return path[:-len(ext)], path[-len(ext):]
-    return os.path.splitext(path)
+            return path[:-len(ext)], path[-len(ext):] + volume
+    (root, ext) = os.path.splitext(path)
+    return root, ext + volume
+
+#
+#
+#
+def parse_size(text):
+    """Read a size like '500M' or '4G'
+    """
+    text = text.strip().upper().rstrip('B')
+    units = ['', 'K', 'M', 'G', 'T', 'P']
+    if len(text) > 0 and text[-1] in units[1:]:
+        return int(float(text[:-1]) * (1024 ** units.index(text[-1])))
+    return int(text)
 
 #
 #
@@ -819,7 +3482,7 @@ def getTextResult(settings, section, data):
     elif t == 'dpkg':
         return ""
 
-    if not t in ['folder', 'dir', 'db', 'database', 'svn', 'sync']:
+    if not t in ['folder', 'dir', 'db', 'database', 'svn', 'sync', 'binlog']:
         return 0
 
     # Name
@@ -846,15 +3509,29 @@ def getTextResult(settings, section, data):
         if totalsize > 0:
             size = " [" + sizeof_fmt(totalsize) + "]"
 
+    # Throughput
+    if isinstance(data['ret'], dict) and data['ret'].has_key('stats'):
+        size += " " + str(data['ret']['stats']['files']) + " files, " + throughput(data['ret']['stats'])
+        if data['ret']['stats'].has_key('linked'):
+            size += " (" + str(data['ret']['stats']['copied']) + " copied, " + str(data['ret']['stats']['linked']) + " linked)"
+
+    # Adaptive compression
+    if isinstance(data['ret'], dict) and data['ret'].has_key('compression'):
+        size += " (gzip levels " + compressionLevels(data['ret']['compression']) + ")"
+
     # Processing
     if t == 'folder' or t == 'dir':
         return "Backup folder \"" + name + "\"" + duration + size
     elif t == 'db' or t == 'database':
+        if isinstance(data['ret'], dict) and data['ret'].has_key('tables'):
+            size += " (" + str(data['ret']['tables']['dumped']) + " tables dumped, " + str(data['ret']['tables']['reused']) + " reused)"
         return "Backup " + name + " database" + duration + size
     elif t == 'svn':
         return "Backup SVN repository \"" + name + "\"" + duration + size
     elif t == 'sync' and name:
         return "Synchronize with \"" + name + "\"" + duration + size
+    elif t == 'binlog':
+        return "Ship " + str(len(data['ret']['files'])) + " " + name + " log files" + duration + size
 
     return 0
 
@@ -891,6 +3568,38 @@ def getVars(text, settings, section):
         text = text.replace('{'+match.group(1)+'}', getVar(match.group(1), settings, section))
     return text
 
+#
+#
+#
+def searchCatalog(configFile, command, value, date=None):
+    """Display the result of a catalog search (find, history or stats)
+    """
+    settings = ConfigParser.ConfigParser()
+    if settings.read(configFile) == []:
+        sys.stderr.write("Configuration not found (" + configFile + ")\n")
+        return False
+    catalog = Catalog.existing(settings)
+    if catalog == None:
+        sys.stderr.write("Catalog not found (" + Catalog.filename(settings) + ")\n")
+        return False
+
+    if command == 'stats':
+        archives, files, size, unique, unique_size = catalog.stats()
+        print "%d archives, %d files [%s]" % (archives, files, sizeof_fmt(size))
+        print "%d unique files [%s]" % (unique, sizeof_fmt(unique_size))
+        catalog.close()
+        return True
+
+    rows = catalog.find(value, date) if command == 'find' else catalog.history(value)
+    previous = None
+    for day, path, size, mtime, md5_hash, archive in rows:
+        changed = ' ' if md5_hash == previous or command == 'find' else '*'
+        previous = md5_hash
+        print "%s %s %-50s %8s %s %s" % (day, changed, path, sizeof_fmt(size, ''),
+            datetime.datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M"), archive)
+    catalog.close()
+    return len(rows) > 0
+
 #
 #
 #
@@ -903,38 +3612,69 @@ def main(configFile = None):
     if configFile == None:
         configFile = '/etc/distbackup.cfg'
 
+    global schedule
+
     result = []
     settings = ConfigParser.ConfigParser()
     if settings.read(configFile) == []:
         return False
+    journal = Journal(settings, configFile, resume)
+    if settings.has_option('default', 'deadline'):
+        schedule = Schedule(settings, journal)
     for section in settings.sections():
         if section == 'default':
             continue
-        date_start = datetime.datetime.now()
 
-        # Perform the action
-        ret = processBackup(settings, section, result)
+        # Skip the sections done by the interrupted run (reports are always displayed)
+        data = None
+        if resume and not (settings.has_option(section, 'type') and settings.get(section, 'type') == 'report'):
+            data = journal.completed(section)
+        if data != None:
+            if debug:
+                print DBG_MSG + "* Resume: skip section " + section + DBG_MSG_END
+            ret = data['ret']
+        else:
+            date_start = datetime.datetime.now()
+            journal.start(section)
 
-        date_stop = datetime.datetime.now()
+            # Perform the action
+            try:
+                ret = processBackup(settings, section, result)
+            except BackupError as err:
+                journal.failed(section)
+                errors.append(section)
+                sys.stderr.write("Section " + section + " failed: " + str(err) + "\n")
+                sys.stderr.flush()
+                continue
+            except:
+                journal.failed(section)
+                raise
 
-        if ret != False and ret != 0:
+            date_stop = datetime.datetime.now()
             data = {
                 'start': date_start,
                 'end': date_stop,
                 'section': section,
                 'ret': ret
             }
+            journal.done(section, data)
+
+        if ret != False and ret != 0:
             display = getTextResult(settings, section, data)
             if display != False and display != "" and display != 0:
                 print display
             result.append( data )
+
+    # A run with failed sections can be resumed
+    if len(errors) == 0:
+        journal.finish()
     return result
 
 #
 # Process arguments
 #
 try:
-    optlist, args = getopt.getopt(sys.argv[1:], 'c:', ['debug'])
+    optlist, args = getopt.getopt(sys.argv[1:], 'c:', ['debug', 'resume', 'restore=', 'find=', 'history=', 'date=', 'catalog-stats'])
 except getopt.GetoptError as err:
     print str(err)
     sys.exit(2)
@@ -942,8 +3682,23 @@ except getopt.GetoptError as err:
 # Configuration variables
 configFile = None
 debug = False
+resume = False
+restoreFile = None
+catalogCommand = None
+catalogDate = None
+schedule = None
+errors = []
 DBG_MSG = '\033[95m'
 DBG_MSG_END = '\033[0m'
+VOLUME_REG = re.compile(r'\.(\d{3}|md5)$')
+DATE_REG = re.compile(r'_(\d{4})-(\d{2})-(\d{2})\.', re.UNICODE)
+MYSQL_POSITION_REG = re.compile(r"^-- CHANGE (?:MASTER|REPLICATION SOURCE) TO \w+_LOG_FILE='([^']+)', \w+_LOG_POS=(\d+)", re.MULTILINE)
+STORE_EXTENSIONS = [
+    'jpg', 'jpeg', 'png', 'gif', 'webp', 'heic',
+    'mp3', 'ogg', 'flac', 'aac', 'm4a', 'mp4', 'm4v', 'mkv', 'avi', 'mov', 'webm',
+    'gz', 'tgz', 'bz2', 'xz', 'zst', 'lz4', 'zip', '7z', 'rar', 'jar',
+    'docx', 'xlsx', 'pptx', 'odt', 'ods', 'pdf'
+]
 
 # Read parameters
 for o, a in optlist:
@@ -951,6 +3706,36 @@ for o, a in optlist:
         configFile = a
     elif o == "--debug":
         debug = True
+    elif o == "--resume":
+        resume = True
+    elif o == "--restore":
+        restoreFile = a
+    elif o == "--find":
+        catalogCommand = ('find', a)
+    elif o == "--history":
+        catalogCommand = ('history', a)
+    elif o == "--catalog-stats":
+        catalogCommand = ('stats', None)
+    elif o == "--date":
+        catalogDate = a
+
+#
+# Restore a database dump
+#
+if restoreFile != None:
+    if not DeltaArchive.restore(restoreFile, sys.stdout):
+        sys.stderr.write("Cannot restore " + restoreFile + "\n")
+        sys.stderr.flush()
+        sys.exit(2)
+    sys.exit(0)
+
+#
+# Search in the catalog
+#
+if catalogCommand != None:
+    if not searchCatalog(configFile or '/etc/distbackup.cfg', catalogCommand[0], catalogCommand[1], catalogDate):
+        sys.exit(2)
+    sys.exit(0)
 
 #
 # Do the backup stuff
@@ -962,7 +3747,10 @@ if result == False:
     sys.stderr.flush()
     sys.exit(2)
 
-if len(result) == 0:
+if len(result) == 0 and len(errors) == 0:
     sys.stderr.write("Nothing to do\n")
     sys.stderr.flush()
     sys.exit(1)
+
+if len(errors) > 0:
+    sys.exit(2)